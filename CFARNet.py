@@ -27,6 +27,7 @@ class IndexPredictionCNN(nn.Module):
         Y_fft=torch.fft.fft(Y_complex, dim=1); Y_fft_shift=torch.fft.fftshift(Y_fft, dim=1)
         Y_magnitude=torch.abs(Y_fft_shift); Y_magnitude_log=torch.log1p(Y_magnitude)
         Y_input=Y_magnitude_log.unsqueeze(1)
+        if Y_input.is_cuda: Y_input=Y_input.contiguous(memory_format=torch.channels_last) # NHWC fast path for cuDNN conv/BN
         features=self.feature_extractor(Y_input); features_pooled=torch.max(features, dim=2)[0]
         logits=self.predictor(features_pooled); logits=logits.squeeze(1)
         return logits, Y_magnitude_log
@@ -40,7 +41,7 @@ import traceback
 import math
 import datetime
 from itertools import islice
-from functions import load_system_params
+from functions import load_system_params, find_latest_model
 from torch.utils.data import Dataset, DataLoader
 from scipy.optimize import linear_sum_assignment
 
@@ -186,17 +187,14 @@ def main_test():
 
     # --- Load Trained Model ---
     print(f"Loading CNN model from: {args.model_dir}") # English print
-    model_path = None; potential_models = []
-    if os.path.isdir(args.model_dir):
-        potential_models = sorted([f for f in os.listdir(args.model_dir) if f.startswith('best_model') and f.endswith('.pt')], key=lambda f: os.path.getmtime(os.path.join(args.model_dir, f)), reverse=True)
-    if potential_models: model_path = os.path.join(args.model_dir, potential_models[0])
-    if not model_path or not os.path.exists(model_path): fallback_path = os.path.join(args.model_dir, 'best_model.pt'); model_path = fallback_path if os.path.exists(fallback_path) else None
+    model_path = find_latest_model(args.model_dir) # Newest best_model*.pt (includes best_model.pt)
     assert model_path, f"Model file not found in {args.model_dir}"
     cnn_hidden_dim = 512; cnn_dropout = 0.1 # Example hyperparameters - Ensure these match the *trained* model
     # <<< Make sure M_plus_1 and Ns passed to model are correct >>>
     model = IndexPredictionCNN(M_plus_1, Ns, hidden_dim=cnn_hidden_dim, dropout=cnn_dropout).to(device)
-    try: model.load_state_dict(torch.load(model_path, map_location=device)); print(f"Loaded Model weights: {model_path}") # English print
+    try: model.load_state_dict(torch.load(model_path, map_location='cpu', weights_only=True)); print(f"Loaded Model weights: {model_path}") # English print
     except Exception as e: raise RuntimeError(f"Error loading state_dict: {e}")
+    if device.type == 'cuda': model = model.to(memory_format=torch.channels_last) # Conv2d weights in NHWC to match the inputs
     model.eval()
 
     # --- Prepare Data Loader ---
@@ -245,18 +243,18 @@ def main_test():
     # ==============================================================
     # Pass 1: CNN -> Angle -> MUSIC R/V -> Store Raw
     # ==============================================================
-    with torch.no_grad():
+    with torch.inference_mode(): # Lighter than no_grad: no autograd bookkeeping at all
         for batch in test_pbar:
             if sample_idx_counter >= num_samples_to_process: break
 
             # 1. Get Data & Store GT
-            clean_echo = batch['echo'].to(device)
+            clean_echo = batch['echo'].to(device, non_blocking=True) # Async H2D from the pinned batch
             gt_theta = batch['theta'].cpu().numpy().squeeze(0); gt_r = batch['r'].cpu().numpy().squeeze(0); gt_vr = batch['vr'].cpu().numpy().squeeze(0)
             true_theta[sample_idx_counter, :] = gt_theta; true_r[sample_idx_counter, :] = gt_r; true_v[sample_idx_counter, :] = gt_vr
 
             # 2. Add Noise
             scaled_echo = clean_echo * pt_scaling_factor
-            noise = (torch.randn_like(scaled_echo.real) + 1j * torch.randn_like(scaled_echo.imag)) * noise_std_dev_tensor
+            noise = torch.view_as_complex(torch.randn(scaled_echo.shape + (2,), device=scaled_echo.device)) * noise_std_dev_tensor # One RNG call for real+imag
             y_echo_noisy = scaled_echo + noise
 
             # 3. CNN Prediction & Get Top-K Indices
@@ -423,7 +423,7 @@ for current_pt_dbm in pt_dbm_test_list:
 
         # --- 3.2 Add Noise (using current_pt_dbm's scaling factor) ---
         scaled_echo = clean_echo * pt_scaling_factor # Use factor calculated for this Pt loop
-        noise = (torch.randn_like(scaled_echo.real) + 1j * torch.randn_like(scaled_echo.imag)) * noise_std_dev_tensor
+        noise = torch.view_as_complex(torch.randn(scaled_echo.shape + (2,), device=scaled_echo.device)) * noise_std_dev_tensor # One RNG call for real+imag
         y_echo_noisy = scaled_echo + noise # Still a tensor [1, Ns, M+1]
 
         # --- 3.3 Signal Processing Pipeline (YOLO/CFAR/MUSIC - Numpy based) ---
@@ -23,6 +23,7 @@ import os
 import math
 import gc
 import traceback # For error reporting
+import zipfile
 
 class ChunkedMovingISACDataset(Dataset):
     """
@@ -309,6 +310,90 @@ def compute_echo_from_factors_optimized(
 
     return echo
 
+def npz_array_shape(npz_path, key):
+    """
+    Read the shape of one array stored in an .npz archive from its .npy header only
+    (no decompression / loading of the array data).
+
+    Args:
+        npz_path (str): Path to the .npz file.
+        key (str): Array name inside the archive.
+
+    Returns:
+        tuple: Array shape.
+    """
+    with zipfile.ZipFile(npz_path) as zf:
+        with zf.open(f'{key}.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0): shape, _, _ = np.lib.format.read_array_header_1_0(f)
+            else: shape, _, _ = np.lib.format.read_array_header_2_0(f)
+    return shape
+
+def convert_echo_chunks_to_complex64(echoes_dir):
+    """
+    One-time migration of echo_chunk_*.npy files to complex64 (the dtype used by the model),
+    for datasets generated before echoes were saved as complex64. Files already in complex64 are skipped.
+
+    Args:
+        echoes_dir (str): Directory containing echo_chunk_*.npy files.
+
+    Returns:
+        int: Number of converted files.
+    """
+    converted = 0
+    for name in sorted(os.listdir(echoes_dir)):
+        if not (name.startswith('echo_chunk_') and name.endswith('.npy')): continue
+        path = os.path.join(echoes_dir, name)
+        echo_chunk = np.load(path, mmap_mode='r')
+        if echo_chunk.dtype == np.complex64: continue
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, echo_chunk.astype(np.complex64))
+        del echo_chunk
+        os.replace(tmp_path, path)
+        converted += 1
+    print(f"[Info] Converted {converted} echo chunk(s) in {echoes_dir} to complex64")
+    return converted
+
+def export_m_peak_npy(data_root, key=None):
+    """
+    One-time export of the m_peak array from trajectory_data.npz to a plain m_peak.npy next to it,
+    so datasets can memory-map the labels instead of decompressing the .npz in every process.
+
+    Args:
+        data_root (str): Directory containing trajectory_data.npz.
+        key (str, optional): Array name inside the archive; defaults to 'm_peak_indices', then 'm_peak'.
+
+    Returns:
+        str: Path of the written m_peak.npy.
+    """
+    traj_path = os.path.join(data_root, 'trajectory_data.npz')
+    npy_path = os.path.join(data_root, 'm_peak.npy')
+    with np.load(traj_path) as traj_data:
+        if key is None: key = 'm_peak_indices' if 'm_peak_indices' in traj_data.files else 'm_peak'
+        m_peak = traj_data[key]
+    tmp_path = npy_path + '.tmp.npy'
+    np.save(tmp_path, np.ascontiguousarray(m_peak))
+    os.replace(tmp_path, npy_path)
+    print(f"[Info] Exported '{key}' {m_peak.shape} from {traj_path} to {npy_path}")
+    return npy_path
+
+def find_latest_model(model_dir, prefix='best_model'):
+    """
+    Newest <prefix>*.pt checkpoint in model_dir, from a single os.scandir pass (one stat per matching file, none for the rest).
+
+    Args:
+        model_dir (str): Directory to search.
+        prefix (str): Checkpoint file name prefix.
+
+    Returns:
+        str or None: Path of the most recently modified match, None if the directory is missing or has no match.
+    """
+    if not os.path.isdir(model_dir): return None
+    with os.scandir(model_dir) as entries:
+        candidates = [(entry.stat().st_mtime, entry.path) for entry in entries
+                      if entry.name.startswith(prefix) and entry.name.endswith('.pt') and entry.is_file()]
+    return max(candidates)[1] if candidates else None
+
 def load_system_params(param_file):
     data = np.load(param_file)
     D_rayleigh = data['D_rayleigh']
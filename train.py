@@ -7,21 +7,86 @@ import torch.nn as nn
 import argparse
 import datetime
 import torch.optim as optim
-from torch.utils.data import Dataset, DataLoader 
+from torch.utils.data import Dataset, DataLoader, Sampler
 from tqdm import tqdm
 import math
 import torch.nn.functional as F
 from torch.optim.lr_scheduler import CosineAnnealingLR
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import gc 
 import sys 
 import traceback 
+import atexit
+import collections
+import concurrent.futures
+import copy
+import io
 from typing import List, Dict, Tuple, Any 
-from functions import load_system_params
+from matplotlib.figure import Figure
+from functions import load_system_params, npz_array_shape, find_latest_model
+# Optional: Numba-compiled target builder (falls back to NumPy if numba is not installed)
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'numba')) # Reuse compiled kernels across runs/workers
+try: import numba
+except ImportError: numba = None
+# Optional: Triton fused KLDiv loss kernel for CUDA (falls back to log_softmax + KLDivLoss if triton is not installed)
+try:
+    import triton
+    import triton.language as tl
+except ImportError: triton = None
 
 # --- Constants ---
 K_BOLTZMANN = 1.38e-23
 T_NOISE_KELVIN = 290 # Standard noise temperature
 
+if numba is not None:
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def build_targets_numba(peaks, M_plus_1, sigma, out):
+        """
+        Numba kernel for ChunkedEchoDataset._build_targets: writes the normalized sum-of-Gaussians
+        target of every sample (parallel over samples) into the preallocated float32 buffer out (N, M+1).
+        """
+        inv_two_sigma_sq = 0.5 / (sigma * sigma)
+        for n in numba.prange(peaks.shape[0]):
+            total = 0.0
+            for m in range(M_plus_1):
+                acc = 0.0
+                for k in range(peaks.shape[1]):
+                    p = peaks[n, k]
+                    if p >= 0 and p < M_plus_1:
+                        d = m - p
+                        acc += math.exp(-d * d * inv_two_sigma_sq)
+                out[n, m] = acc
+                total += acc
+            if total > 0:
+                for m in range(M_plus_1):
+                    out[n, m] /= total
+
+    @numba.njit(parallel=True, cache=True, fastmath=True)
+    def build_targets_sparse_numba(peaks, M_plus_1, sigma, radius, out):
+        """
+        Windowed variant of build_targets_numba: each valid peak only adds its Gaussian to the bins within
+        `radius` of it (O(K * radius) per sample instead of O(K * (M+1))).
+        """
+        inv_two_sigma_sq = 0.5 / (sigma * sigma)
+        for n in numba.prange(peaks.shape[0]):
+            for m in range(M_plus_1):
+                out[n, m] = 0.0
+            for k in range(peaks.shape[1]):
+                p = peaks[n, k]
+                if p >= 0 and p < M_plus_1:
+                    for m in range(max(0, p - radius), min(M_plus_1, p + radius + 1)):
+                        d = m - p
+                        out[n, m] += math.exp(-d * d * inv_two_sigma_sq)
+            total = 0.0
+            for m in range(M_plus_1):
+                total += out[n, m]
+            if total > 0:
+                for m in range(M_plus_1):
+                    out[n, m] /= total
+else:
+    build_targets_numba = None
+    build_targets_sparse_numba = None
+
 
 
 
@@ -29,10 +94,10 @@ T_NOISE_KELVIN = 290 # Standard noise temperature
 class ChunkedEchoDataset(Dataset):
     """
     Load pre-computed *noiseless* echo signals (yecho) from chunked .npy files
-    and target peaks (m_peak).
+    and target peaks (m_peak), plus the Gaussian-smoothed target built from m_peak.
     """
     # expected_k now directly controlled by args.max_targets
-    def __init__(self, data_root, start_idx, end_idx, expected_k):
+    def __init__(self, data_root, start_idx, end_idx, expected_k, target_sigma=1.0, mmap_cache_size=4, target_method='sparse'):
         """
         Initialize dataset.
 
@@ -42,6 +107,9 @@ class ChunkedEchoDataset(Dataset):
             start_idx (int): Starting absolute index for this dataset slice.
             end_idx (int): Ending absolute index for this dataset slice.
             expected_k (int): Expected maximum number of targets K (for m_peak padding/truncation).
+            target_sigma (float): Standard deviation of the Gaussian smooth target (args.loss_sigma).
+            mmap_cache_size (int): Number of memory-mapped echo chunks kept open (LRU) per process.
+            target_method (str): 'sparse' (Gaussians evaluated only near each peak) or 'dense' (full grid), see _build_targets.
         """
         super().__init__()
         self.data_root = data_root
@@ -49,6 +117,12 @@ class ChunkedEchoDataset(Dataset):
         self.end_idx = end_idx
         self.num_samples = end_idx - start_idx + 1
         self.expected_k = expected_k # Now set by args.max_targets
+        self.target_sigma = target_sigma
+        if target_method not in ('sparse', 'dense'): raise ValueError(f"Unknown target_method: {target_method}")
+        self.target_method = target_method
+        self.mmap_cache_size = max(1, mmap_cache_size)
+        self._mmap_cache = collections.OrderedDict() # chunk_idx -> np.memmap, opened lazily in each process
+        self.pin_memory = False # Set by make_loader from the loader's pin_memory (i.e. training on CUDA)
 
         print(f"  Dataset initialization: root='{data_root}', range=[{start_idx}, {end_idx}], count={self.num_samples}, expected_K={self.expected_k}") # Added expected_k here
 
@@ -72,73 +146,358 @@ class ChunkedEchoDataset(Dataset):
             if self.Ns: print(f"  Loaded Ns from params: {self.Ns}")
         except Exception as e: raise IOError(f"Error loading or parsing system_params.npz: {e}")
         if self.chunk_size <= 0: raise ValueError("samples_per_chunk must be positive.")
-
-        traj_path = os.path.join(data_root, 'trajectory_data.npz')
-        if not os.path.isfile(traj_path): raise FileNotFoundError(f"Trajectory data file not found: {traj_path}")
+        if not self.M_plus_1: raise KeyError("'M' not found in system_params.npz (needed to build smooth targets).")
+
+        # Echo chunks are expected on disk as complex64 (as written by data_generation.py), so samples need no cast
+        first_chunk_path = os.path.join(self.echoes_dir, f'echo_chunk_{start_idx // self.chunk_size}.npy')
+        self.echo_dtype = np.load(first_chunk_path, mmap_mode='r').dtype if os.path.isfile(first_chunk_path) else np.dtype(np.complex64)
+        if self.echo_dtype != np.complex64:
+            print(f"  Warning: echo chunks are stored as {self.echo_dtype}; every batch will be cast to complex64. "
+                  f"Run functions.convert_echo_chunks_to_complex64('{self.echoes_dir}') once to convert them.")
+
+        self.traj_path = os.path.join(data_root, 'trajectory_data.npz')
+        # Plain .npy export of m_peak (see functions.export_m_peak_npy), memory-mapped instead of decompressing the .npz
+        self.m_peak_npy_path = os.path.join(data_root, 'm_peak.npy')
+        if not os.path.isfile(self.m_peak_npy_path): self.m_peak_npy_path = None
+        if self.m_peak_npy_path is None and not os.path.isfile(self.traj_path): raise FileNotFoundError(f"Trajectory data file not found: {self.traj_path}")
         try:
-            traj_data = np.load(traj_path)
-            if 'm_peak_indices' not in traj_data:
-                if 'm_peak' in traj_data: m_peak_all = traj_data['m_peak']
-                else: raise KeyError("'m_peak_indices' or 'm_peak' not found in trajectory_data.npz")
-            else: m_peak_all = traj_data['m_peak_indices']
-            total_samples_in_file = m_peak_all.shape[0]
+            # Only the .npy header is read here; the m_peak array itself is loaded by m_peak_targets below
+            if self.m_peak_npy_path is not None:
+                self.m_peak_key = 'm_peak.npy'
+                total_samples_in_file = np.load(self.m_peak_npy_path, mmap_mode='r').shape[0]
+            else:
+                with np.load(self.traj_path) as traj_data:
+                    if 'm_peak_indices' not in traj_data.files:
+                        if 'm_peak' in traj_data.files: self.m_peak_key = 'm_peak'
+                        else: raise KeyError("'m_peak_indices' or 'm_peak' not found in trajectory_data.npz")
+                    else: self.m_peak_key = 'm_peak_indices'
+                total_samples_in_file = npz_array_shape(self.traj_path, self.m_peak_key)[0]
+                print(f"  Info: m_peak is read from the compressed trajectory_data.npz. Run "
+                      f"functions.export_m_peak_npy('{data_root}') once to memory-map it from m_peak.npy instead.")
             if self.end_idx >= total_samples_in_file:
                 print(f"Warning: Requested end_idx ({self.end_idx}) exceeds available samples in trajectory_data.npz ({total_samples_in_file}).")
                 self.end_idx = total_samples_in_file - 1; self.num_samples = self.end_idx - self.start_idx + 1
                 if self.num_samples <= 0: raise ValueError(f"Invalid adjusted sample range [{self.start_idx}, {self.end_idx}]")
                 print(f"  Adjusted dataset range: [{self.start_idx}, {self.end_idx}], count={self.num_samples}")
-            self.m_peak_targets = m_peak_all[self.start_idx : self.end_idx + 1]
-            print(f"  Loaded m_peak_targets, original shape: {self.m_peak_targets.shape}")
+        except Exception as e: raise IOError(f"Error loading or processing trajectory_data.npz: {e}")
+        # Path of every echo chunk in range, checked once here (None if missing) instead of on each chunk open
+        first_chunk, last_chunk = self.start_idx // self.chunk_size, self.end_idx // self.chunk_size
+        self._chunk_paths = {}
+        for chunk_idx in range(first_chunk, last_chunk + 1):
+            echo_file_path = os.path.join(self.echoes_dir, f'echo_chunk_{chunk_idx}.npy')
+            self._chunk_paths[chunk_idx] = echo_file_path if os.path.isfile(echo_file_path) else None
+        missing_chunks = [chunk_idx for chunk_idx, path in self._chunk_paths.items() if path is None]
+        if missing_chunks: print(f"  Warning: {len(missing_chunks)} echo chunk file(s) missing in {self.echoes_dir} (chunks {missing_chunks[:10]}{'...' if len(missing_chunks) > 10 else ''})")
+        self._m_peak_targets = None
+        self._target_smooth = None
+
+    def share_label_memory(self):
+        """
+        Materializes both label buffers in shared memory; called by make_loader before the DataLoader
+        starts its workers, so every worker reads the same pages instead of building a private copy.
+        """
+        self.m_peak_targets.share_memory_()
+        self.target_smooth.share_memory_()
+
+    @property
+    def m_peak_targets(self):
+        """(num_samples, expected_k) long tensor of peak indices, loaded from m_peak.npy (memory-mapped) or trajectory_data.npz on first access."""
+        if self._m_peak_targets is None:
+            self._m_peak_targets = torch.from_numpy(np.ascontiguousarray(self._load_m_peak_targets())).to(torch.long)
+        return self._m_peak_targets
+
+    def _load_m_peak_targets(self):
+        try:
+            if self.m_peak_npy_path is not None:
+                # Only the pages of this dataset's [start_idx, end_idx] range are read from the memmap, into an owned copy
+                m_peak_targets = np.array(np.load(self.m_peak_npy_path, mmap_mode='r')[self.start_idx : self.end_idx + 1])
+            else:
+                with np.load(self.traj_path) as traj_data:
+                    m_peak_targets = traj_data[self.m_peak_key][self.start_idx : self.end_idx + 1]
+            print(f"  Loaded m_peak_targets, original shape: {m_peak_targets.shape}")
 
             # --- Adjust loaded targets based on expected_k ---
-            actual_k_in_data = self.m_peak_targets.shape[1] if self.m_peak_targets.ndim > 1 else 1
+            actual_k_in_data = m_peak_targets.shape[1] if m_peak_targets.ndim > 1 else 1
             if actual_k_in_data < self.expected_k:
                 print(f"  Info: m_peak_targets K dimension ({actual_k_in_data}) is less than expected_k ({self.expected_k}). Will pad.")
                 pad_width = self.expected_k - actual_k_in_data
                 # Pad with -1 (invalid index)
-                self.m_peak_targets = np.pad(self.m_peak_targets, ((0, 0), (0, pad_width)), 'constant', constant_values=-1)
-                print(f"  Padded m_peak_targets shape: {self.m_peak_targets.shape}")
+                m_peak_targets = np.pad(m_peak_targets, ((0, 0), (0, pad_width)), 'constant', constant_values=-1)
+                print(f"  Padded m_peak_targets shape: {m_peak_targets.shape}")
             elif actual_k_in_data > self.expected_k:
                  print(f"  Warning: m_peak_targets K dimension ({actual_k_in_data}) is greater than expected_k ({self.expected_k}). Will truncate.")
-                 self.m_peak_targets = self.m_peak_targets[:, :self.expected_k]
-                 print(f"  Truncated m_peak_targets shape: {self.m_peak_targets.shape}")
+                 m_peak_targets = m_peak_targets[:, :self.expected_k]
+                 print(f"  Truncated m_peak_targets shape: {m_peak_targets.shape}")
             # ---
-
+            return m_peak_targets
         except Exception as e: raise IOError(f"Error loading or processing trajectory_data.npz: {e}")
 
+    @property
+    def target_smooth(self):
+        """(num_samples, M+1) float16 tensor of smooth targets (see _build_targets), built once on first access."""
+        if self._target_smooth is None:
+            self._target_smooth = torch.from_numpy(self._build_targets(self.m_peak_targets.numpy(), self.M_plus_1, self.target_sigma, method=self.target_method))
+        return self._target_smooth
+
+    @staticmethod
+    def _build_targets(m_peak_targets, M_plus_1, sigma, block_size=1024, method='sparse'):
+        """
+        Gaussian smooth targets for all samples: sum of Gaussians at the valid peaks,
+        normalized to sum to 1 (all zeros if a sample has no valid peak).
+        Uses the Numba kernels when numba is installed, NumPy otherwise.
+        'sparse' only evaluates each Gaussian within 6 sigma of its peak; the terms it drops are < 1.6e-8 of the
+        peak value, below float16 resolution, so it matches 'dense' (every bin x every peak) in the stored targets.
+
+        Args:
+            m_peak_targets (np.ndarray): Peak indices (N, K), -1 for padding.
+            M_plus_1 (int): Total number of frequency bins.
+            sigma (float): Standard deviation of the Gaussian.
+            block_size (int): Samples processed per step (bounds the (block, M+1, K) temporary).
+            method (str): 'sparse' or 'dense'.
+
+        Returns:
+            np.ndarray: Smooth targets (N, M+1), float16.
+        """
+        peaks = np.asarray(m_peak_targets).reshape(len(m_peak_targets), -1)
+        radius = int(math.ceil(6 * sigma))
+        if method == 'sparse' and build_targets_sparse_numba is not None:
+            targets_f32 = np.empty((peaks.shape[0], M_plus_1), dtype=np.float32)
+            build_targets_sparse_numba(np.ascontiguousarray(peaks, dtype=np.int64), M_plus_1, float(sigma), radius, targets_f32)
+            return targets_f32.astype(np.float16)
+        if method == 'sparse':
+            return ChunkedEchoDataset._build_targets_sparse(peaks, M_plus_1, sigma, radius, block_size)
+        if build_targets_numba is not None:
+            targets_f32 = np.empty((peaks.shape[0], M_plus_1), dtype=np.float32)
+            build_targets_numba(np.ascontiguousarray(peaks, dtype=np.int64), M_plus_1, float(sigma), targets_f32)
+            return targets_f32.astype(np.float16)
+        valid = (peaks >= 0) & (peaks < M_plus_1)
+        positions = np.arange(M_plus_1, dtype=np.float32)
+        targets = np.zeros((peaks.shape[0], M_plus_1), dtype=np.float16)
+        for start in range(0, peaks.shape[0], block_size):
+            block = slice(start, start + block_size)
+            dist = (positions[None, :, None] - peaks[block, None, :].astype(np.float32)) / sigma # (b, M+1, K)
+            gaussian_sum = (np.exp(-0.5 * dist ** 2) * valid[block, None, :]).sum(axis=2)
+            totals = gaussian_sum.sum(axis=1, keepdims=True)
+            np.divide(gaussian_sum, totals, out=gaussian_sum, where=totals > 0)
+            targets[block] = gaussian_sum
+        return targets
+
+    @staticmethod
+    def _build_targets_sparse(peaks, M_plus_1, sigma, radius, block_size=1024):
+        """NumPy version of build_targets_sparse_numba: scatter-adds a (2*radius+1)-tap Gaussian at every valid peak."""
+        offsets = np.arange(-radius, radius + 1)
+        weights = np.exp(-0.5 * (offsets / sigma) ** 2)
+        targets = np.zeros((peaks.shape[0], M_plus_1), dtype=np.float16)
+        for start in range(0, peaks.shape[0], block_size):
+            block_peaks = peaks[start:start + block_size]
+            b = block_peaks.shape[0]
+            positions = block_peaks[:, :, None] + offsets # (b, K, 2*radius+1)
+            keep = ((block_peaks >= 0) & (block_peaks < M_plus_1))[:, :, None] & (positions >= 0) & (positions < M_plus_1)
+            flat_bins = (np.arange(b)[:, None, None] * M_plus_1 + positions)[keep]
+            gaussian_sum = np.bincount(flat_bins, weights=np.broadcast_to(weights, positions.shape)[keep], minlength=b * M_plus_1).reshape(b, M_plus_1)
+            totals = gaussian_sum.sum(axis=1, keepdims=True)
+            np.divide(gaussian_sum, totals, out=gaussian_sum, where=totals > 0)
+            targets[start:start + b] = gaussian_sum
+        return targets
+
     def __len__(self):
         return self.num_samples
 
+    def _get_chunk(self, chunk_idx):
+        """Returns the memory-mapped echo chunk, opening it on a cache miss and evicting the least recently used one."""
+        echo_chunk = self._mmap_cache.get(chunk_idx)
+        if echo_chunk is not None:
+            self._mmap_cache.move_to_end(chunk_idx)
+            return echo_chunk
+        echo_file_path = self._chunk_paths.get(chunk_idx)
+        if echo_file_path is None: raise FileNotFoundError(f"Echo data file not found: {os.path.join(self.echoes_dir, f'echo_chunk_{chunk_idx}.npy')} (requested chunk {chunk_idx})")
+        echo_chunk = np.load(echo_file_path, mmap_mode='r', allow_pickle=False)
+        # Check dimensions if M_plus_1 and Ns are known (skipped under python -O)
+        if __debug__ and self.Ns and self.M_plus_1 and echo_chunk.ndim >= 3 and echo_chunk.shape[1:] != (self.Ns, self.M_plus_1):
+            print(f"Warning (chunk={chunk_idx}): echo_chunk shape {echo_chunk.shape} does not match expected ({(-1, self.Ns, self.M_plus_1)})")
+        self._mmap_cache[chunk_idx] = echo_chunk
+        if len(self._mmap_cache) > self.mmap_cache_size:
+            self._mmap_cache.popitem(last=False)
+        return echo_chunk
+
     def __getitem__(self, index):
         if index < 0 or index >= self.num_samples: raise IndexError(f"Index {index} out of range [0, {self.num_samples - 1}]")
         try:
             absolute_idx = self.start_idx + index
             chunk_idx = absolute_idx // self.chunk_size
             index_in_chunk = absolute_idx % self.chunk_size
-            echo_file_path = os.path.join(self.echoes_dir, f'echo_chunk_{chunk_idx}.npy')
-            if not os.path.isfile(echo_file_path): raise FileNotFoundError(f"Echo data file not found: {echo_file_path} (requested chunk {chunk_idx})")
-            echo_chunk = np.load(echo_file_path)
-            # Check dimensions if M_plus_1 and Ns are known
-            if self.Ns and self.M_plus_1 and echo_chunk.ndim >= 3 and echo_chunk.shape[1:] != (self.Ns, self.M_plus_1):
-                print(f"Warning (idx={absolute_idx}, chunk={chunk_idx}): echo_chunk shape {echo_chunk.shape} does not match expected ({(-1, self.Ns, self.M_plus_1)})")
+            echo_chunk = self._get_chunk(chunk_idx)
             if index_in_chunk >= echo_chunk.shape[0]: raise IndexError(f"Index {index_in_chunk} exceeds loaded chunk size ({echo_chunk.shape[0]}) for file echo_chunk_{chunk_idx}.npy (absolute index {absolute_idx})")
 
-            clean_echo_signal = echo_chunk[index_in_chunk]
-            m_peak = self.m_peak_targets[index] # Already adjusted to expected_k
+            # Owned copy of one row: the memmap is read-only and must not back the returned tensor (one cast for legacy non-complex64 chunks)
+            clean_echo_signal = np.array(echo_chunk[index_in_chunk], dtype=np.complex64)
 
             # Convert to tensors
-            echo_tensor = torch.from_numpy(clean_echo_signal).to(torch.complex64)
-            # Ensure m_peak is LONG type for indexing/embedding later if needed
-            m_peak_tensor = torch.from_numpy(m_peak).to(torch.long)
+            echo_tensor = torch.from_numpy(clean_echo_signal)
+            m_peak_tensor = self.m_peak_targets[index] # Long tensor, already adjusted to expected_k
+            target_tensor = self.target_smooth[index]
 
-            sample = {'echo': echo_tensor, 'm_peak': m_peak_tensor}
+            sample = {'echo': echo_tensor, 'm_peak': m_peak_tensor, 'target': target_tensor}
             return sample
         except FileNotFoundError as e: print(f"Error: File not found when loading index {index} (absolute {self.start_idx + index}): {e}", flush=True); raise
         except IndexError as e: print(f"Error: Index out of range when loading index {index} (absolute {self.start_idx + index}): {e}", flush=True); raise
         except Exception as e: print(f"Error: Unexpected error when loading index {index} (absolute {self.start_idx + index}): {e}", flush=True); traceback.print_exc(); raise
 
+    def _read_rows_into(self, chunk_idx, echo_chunk, rows, out, positions):
+        """
+        Reads rows of a complex64 echo chunk straight from the file into out[positions] (one copy from the
+        page cache into the batch buffer, instead of a fancy-indexed memmap temporary followed by a second copy).
+        echo_chunk is the chunk's memmap; only its header offset and row size are used.
+        """
+        row_bytes = echo_chunk[0].nbytes
+        out_bytes = out.reshape(out.shape[0], -1).view(np.uint8)
+        with open(self._chunk_paths[chunk_idx], 'rb', buffering=0) as f:
+            for row, position in zip(rows.tolist(), positions.tolist()):
+                f.seek(echo_chunk.offset + row * row_bytes)
+                if f.readinto(out_bytes[position]) != row_bytes:
+                    raise IndexError(f"Short read of row {row} from echo_chunk_{chunk_idx}.npy")
+
+    def __getitems__(self, indices):
+        """
+        Batched fetch used by the DataLoader fetcher instead of one __getitem__ call per index.
+        Indices are grouped by chunk so every echo_chunk_*.npy is looked up (memory-mapped, LRU cached) once per batch.
+
+        Args:
+            indices (list[int]): Relative sample indices of one batch.
+
+        Returns:
+            dict: Pre-stacked batch {'echo': (B, Ns, M+1) complex64, 'm_peak': (B, expected_k) long,
+                  'target': (B, M+1) float16 smooth target}.
+                  Use with passthrough_collate so the DataLoader does not collate it again.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if indices.size > 0 and (indices.min() < 0 or indices.max() >= self.num_samples):
+            raise IndexError(f"Batch indices out of range [0, {self.num_samples - 1}]")
+        absolute_idx = self.start_idx + indices
+        chunk_ids = absolute_idx // self.chunk_size
+        in_chunk = absolute_idx % self.chunk_size
+        unique_chunks, inverse = np.unique(chunk_ids, return_inverse=True)
+        try:
+            echo_batch = None
+            for u, chunk_idx in enumerate(unique_chunks):
+                echo_chunk = self._get_chunk(chunk_idx)
+                batch_positions = np.nonzero(inverse == u)[0]
+                rows = in_chunk[batch_positions]
+                if rows.max() >= echo_chunk.shape[0]: raise IndexError(f"Index {rows.max()} exceeds loaded chunk size ({echo_chunk.shape[0]}) for file echo_chunk_{chunk_idx}.npy")
+                if echo_batch is None:
+                    # Pinned when loading in the main process, so the H2D copy can be asynchronous
+                    pin = self.pin_memory and torch.utils.data.get_worker_info() is None
+                    echo_batch = torch.empty((len(indices),) + echo_chunk.shape[1:], dtype=torch.complex64, pin_memory=pin)
+                    echo_batch_np = echo_batch.numpy()
+                if echo_chunk.dtype == np.complex64 and echo_chunk.flags.c_contiguous:
+                    self._read_rows_into(chunk_idx, echo_chunk, rows, echo_batch_np, batch_positions)
+                else:
+                    # Legacy non-complex64 chunks are cast while copying the rows
+                    echo_batch_np[batch_positions] = echo_chunk[rows] # Only the requested rows are read from disk
+            index_tensor = torch.from_numpy(indices)
+
+            return {'echo': echo_batch,
+                    'm_peak': self.m_peak_targets[index_tensor],
+                    'target': self.target_smooth[index_tensor]}
+        except FileNotFoundError as e: print(f"Error: File not found when loading batch (chunks {unique_chunks.tolist()}): {e}", flush=True); raise
+        except IndexError as e: print(f"Error: Index out of range when loading batch (chunks {unique_chunks.tolist()}): {e}", flush=True); raise
+        except Exception as e: print(f"Error: Unexpected error when loading batch (chunks {unique_chunks.tolist()}): {e}", flush=True); traceback.print_exc(); raise
+
+
+def passthrough_collate(batch):
+    """collate_fn for ChunkedEchoDataset: __getitems__ already returns a stacked batch dict."""
+    return batch
+
+
+def echo_worker_init_fn(worker_id):
+    """DataLoader worker_init_fn: start each worker with an empty memmap cache instead of handles inherited from the parent."""
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None and isinstance(worker_info.dataset, ChunkedEchoDataset):
+        worker_info.dataset._mmap_cache = collections.OrderedDict()
+
+
+class ChunkAwareBatchSampler(Sampler):
+    """
+    Shuffling batch sampler that keeps consecutive batches inside the same echo chunk(s).
+    Each epoch the chunk order is shuffled, samples are shuffled within each group of
+    `chunks_per_group` chunks, and batches are cut from that stream, so the memmap LRU
+    cache of ChunkedEchoDataset stays warm instead of touching a different chunk per sample.
+    """
+    def __init__(self, num_samples, batch_size, chunk_size, start_idx=0, drop_last=False, chunks_per_group=1):
+        """
+        Args:
+            num_samples (int): Dataset length (relative indices 0..num_samples-1).
+            batch_size (int): Batch size.
+            chunk_size (int): Samples per echo chunk file (samples_per_chunk).
+            start_idx (int): Absolute index of relative sample 0 (dataset start_idx).
+            drop_last (bool): Drop the final incomplete batch.
+            chunks_per_group (int): Number of chunks shuffled together (more = more shuffling entropy, less chunk reuse).
+        """
+        if batch_size <= 0: raise ValueError("batch_size must be positive.")
+        if chunk_size <= 0: raise ValueError("chunk_size must be positive.")
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.chunks_per_group = max(1, chunks_per_group)
+        chunk_ids = (start_idx + np.arange(num_samples)) // chunk_size
+        boundaries = np.flatnonzero(np.diff(chunk_ids)) + 1
+        self._chunk_members = np.split(np.arange(num_samples), boundaries) # Relative indices per chunk
+
+    def __iter__(self):
+        chunk_order = np.random.permutation(len(self._chunk_members))
+        stream = np.concatenate([
+            np.random.permutation(np.concatenate([self._chunk_members[c] for c in chunk_order[g:g + self.chunks_per_group]]))
+            for g in range(0, len(chunk_order), self.chunks_per_group)
+        ]) if self.num_samples > 0 else np.empty(0, dtype=np.int64)
+        for start in range(0, self.num_samples, self.batch_size):
+            batch = stream[start:start + self.batch_size]
+            if self.drop_last and len(batch) < self.batch_size: break
+            yield batch.tolist()
+
+    def __len__(self):
+        if self.drop_last: return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def make_loader(dataset, batch_size, training, num_workers=4, pin_memory=False, chunks_per_group=1):
+    """
+    Build a DataLoader for ChunkedEchoDataset with the settings shared by train/val/test.
+
+    Args:
+        dataset (ChunkedEchoDataset): Dataset to load from.
+        batch_size (int): Batch size.
+        training (bool): If True, use ChunkAwareBatchSampler (shuffled, drop_last); otherwise sequential order.
+        num_workers (int): Worker processes (0: load in the main process).
+        pin_memory (bool): Use pinned host memory (set for CUDA).
+        chunks_per_group (int): Passed to ChunkAwareBatchSampler for training.
+
+    Returns:
+        DataLoader: Loader yielding dicts of stacked tensors.
+    """
+    dataset.pin_memory = pin_memory # In-process batches are allocated pinned directly (workers' batches are pinned by the loader)
+    loader_kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory,
+                     'collate_fn': passthrough_collate, 'worker_init_fn': echo_worker_init_fn}
+    if num_workers > 0:
+        dataset.share_label_memory() # In-process loading (num_workers=0) keeps the labels in ordinary memory
+        # Keep workers (and their memmap caches) alive across epochs and buffer a few batches ahead
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    if training:
+        batch_sampler = ChunkAwareBatchSampler(len(dataset), batch_size, dataset.chunk_size, start_idx=dataset.start_idx,
+                                               drop_last=True, chunks_per_group=chunks_per_group)
+        return DataLoader(dataset, batch_sampler=batch_sampler, **loader_kwargs)
+    return DataLoader(dataset, batch_size=batch_size, shuffle=False, **loader_kwargs)
+
 # --- Model definition ---
 
+# --- Fused input preprocessing ---
+def _log1p_magnitude(Y_real_imag):
+    """log(1 + |Y|) from a real (..., 2) view of the complex spectrum (torch.view_as_real)."""
+    return torch.log1p(torch.hypot(Y_real_imag[..., 0], Y_real_imag[..., 1]))
+
+# Inductor does not fuse complex kernels, so only the real-valued magnitude + log1p pass is compiled
+# (one kernel reading the spectrum once); used for CUDA inputs, eager elsewhere.
+_log1p_magnitude_fused = torch.compile(_log1p_magnitude, dynamic=False) if hasattr(torch, 'compile') else _log1p_magnitude
+
 # --- CNN Model (IndexPredictionCNN) ---
 class IndexPredictionCNN(nn.Module):
     def __init__(self, M_plus_1, Ns, hidden_dim=512, dropout=0.2):
@@ -169,6 +528,8 @@ class IndexPredictionCNN(nn.Module):
         )
 
         self.apply(self._init_weights) # Apply weight initialization
+        # Reusable noisy-input buffer (see make_noisy_input); not saved in the state_dict
+        self.register_buffer('_scratch', torch.empty(0, dtype=torch.complex64), persistent=False)
 
     def _init_weights(self, module):
         if isinstance(module, nn.Conv2d) or isinstance(module, nn.Conv1d):
@@ -185,6 +546,28 @@ class IndexPredictionCNN(nn.Module):
              if hasattr(module, 'bias') and module.bias is not None:
                  nn.init.constant_(module.bias, 0)
 
+    def make_noisy_input(self, clean_echo, scaling_factors, noise_std):
+        """
+        Builds the network input scale * clean_echo + complex Gaussian noise for every scaling factor,
+        stacked Pt-major along the batch axis, in the persistent _scratch buffer (no per-batch allocations).
+        The returned tensor is overwritten by the next call.
+
+        Args:
+            clean_echo (torch.Tensor): Noiseless echoes (B, Ns, M+1), complex64, on the model's device.
+            scaling_factors (Sequence[float]): Amplitude scaling factor sqrt(Pt) per power level.
+            noise_std (float): Noise standard deviation of the real and imaginary parts.
+
+        Returns:
+            torch.Tensor: Noisy echoes (len(scaling_factors) * B, Ns, M+1), complex64.
+        """
+        batch_size = clean_echo.shape[0]
+        scratch = self._scratch
+        scratch.resize_((len(scaling_factors) * batch_size,) + tuple(clean_echo.shape[1:]))
+        torch.view_as_real(scratch).normal_(0.0, noise_std) # Independent noise on the real and imaginary parts
+        for i, scale in enumerate(scaling_factors):
+            scratch[i * batch_size:(i + 1) * batch_size].add_(clean_echo, alpha=scale)
+        return scratch
+
     def forward(self, Y_complex):
         B, Ns_actual, M_plus_1_actual = Y_complex.shape
         # --- START: FFT Processing ---
@@ -194,10 +577,9 @@ class IndexPredictionCNN(nn.Module):
         # --- END: FFT Processing ---
 
         # --- START: Feature Extraction Input Preparation ---
-        # Use magnitude as input features
-        Y_magnitude = torch.abs(Y_fft_shift)
-        # Log magnitude to compress dynamic range
-        Y_magnitude_log = torch.log1p(Y_magnitude) # log(1+x) for stability
+        # Use log magnitude as input features: log(1+|Y|) compresses dynamic range
+        log1p_magnitude = _log1p_magnitude_fused if Y_fft_shift.is_cuda else _log1p_magnitude
+        Y_magnitude_log = log1p_magnitude(torch.view_as_real(Y_fft_shift))
 
         # Standardization (Optional - uncomment to try)
         # mean = torch.mean(Y_magnitude_log, dim=(1, 2), keepdim=True)
@@ -206,6 +588,7 @@ class IndexPredictionCNN(nn.Module):
 
         # Add channel dimension: (B, Ns, M+1) -> (B, 1, Ns, M+1)
         Y_input = Y_magnitude_log.unsqueeze(1)
+        if Y_input.is_cuda: Y_input = Y_input.contiguous(memory_format=torch.channels_last) # NHWC fast path for cuDNN conv/BN
         # --- END: Feature Extraction Input Preparation ---
 
         # --- START: Feature Extraction (CNN) ---
@@ -223,45 +606,75 @@ class IndexPredictionCNN(nn.Module):
 
         return logits, Y_magnitude_log # Return logits and the processed input for visualization
 
+def fuse_conv_bn_for_eval(model):
+    """
+    Returns an eval-mode copy of an IndexPredictionCNN with every (Conv, BatchNorm) pair of feature_extractor
+    and predictor folded into a single conv (the BN replaced by nn.Identity), so inference runs one kernel
+    less per block. The original model (used for training) is left untouched.
+    """
+    # The noise scratch buffer (Npt*B activations) is not copied: the fused copy only runs forward on inputs built by model
+    scratch = model._scratch
+    fused = copy.deepcopy(model, memo={id(scratch): torch.empty(0, dtype=scratch.dtype, device=scratch.device)}).eval()
+    for sequential in (fused.feature_extractor, fused.predictor):
+        for i in range(len(sequential) - 1):
+            conv, bn = sequential[i], sequential[i + 1]
+            if isinstance(conv, (nn.Conv1d, nn.Conv2d)) and isinstance(bn, (nn.BatchNorm1d, nn.BatchNorm2d)):
+                sequential[i] = fuse_conv_bn_eval(conv, bn)
+                sequential[i + 1] = nn.Identity()
+    if next(fused.parameters()).is_cuda: fused = fused.to(memory_format=torch.channels_last)
+    return fused
+
 # --- Helper functions ---
 
-# --- Gaussian Target Generation ---
-def create_gaussian_target(peak_indices, M_plus_1, sigma, device):
+# --- Simplified Combined Loss (Only Main Loss) --- 
+# --- Fused KLDiv loss ---
+if triton is not None:
+    @triton.jit
+    def _fused_kldiv_kernel(logits_ptr, target_ptr, row_loss_ptr, lse_ptr, n_cols, logits_row_stride, target_row_stride, BLOCK: tl.constexpr):
+        """
+        One program per batch row: normalizes the target to a distribution, computes log-sum-exp of the logits
+        and writes sum(t * (log(t) - log_softmax(x))) and the row's log-sum-exp, reading each row once.
+        """
+        row = tl.program_id(0)
+        cols = tl.arange(0, BLOCK)
+        mask = cols < n_cols
+        x = tl.load(logits_ptr + row * logits_row_stride + cols, mask=mask, other=-float('inf')).to(tl.float32)
+        t = tl.load(target_ptr + row * target_row_stride + cols, mask=mask, other=0.0).to(tl.float32)
+        x_max = tl.max(x, axis=0)
+        lse = x_max + tl.log(tl.sum(tl.exp(x - x_max), axis=0))
+        t = t / (tl.sum(t, axis=0) + 1e-9)
+        positive = t > 0 # 0 * log(0) terms contribute 0, as in KLDivLoss
+        term = tl.where(positive, t * (tl.log(tl.where(positive, t, 1.0)) - (x - lse)), 0.0)
+        tl.store(row_loss_ptr + row, tl.sum(term, axis=0))
+        tl.store(lse_ptr + row, lse)
+
+
+class FusedKLDivLoss(torch.autograd.Function):
     """
-    Create a Gaussian smooth target distribution based on peak indices.
-    
-    Args:
-        peak_indices (torch.Tensor): Peak indices of shape (K,), 
-                                   where -1 indicates no peak (placeholder).
-        M_plus_1 (int): Total number of frequency bins.
-        sigma (float): Standard deviation for Gaussian distribution.
-        device: Target device for the tensor.
-    
-    Returns:
-        torch.Tensor: Smooth target distribution of shape (M_plus_1,).
+    KLDivLoss(batchmean)(log_softmax(logits), target / target.sum(-1)) in a single Triton kernel (CUDA only).
+    The backward pass is one elementwise expression: (softmax(logits) * sum(t) - t) / B with t the normalized target.
     """
-    # Filter out invalid peak indices (< 0 or >= M_plus_1)
-    valid_peaks = peak_indices[(peak_indices >= 0) & (peak_indices < M_plus_1)]
-    
-    if valid_peaks.numel() == 0:
-        # No valid peaks, return zeros
-        return torch.zeros(M_plus_1, dtype=torch.float32, device=device)
-    
-    # Create position grid
-    positions = torch.arange(M_plus_1, dtype=torch.float32, device=device).unsqueeze(1)
-    
-    # Calculate Gaussian for each valid peak and sum them
-    valid_peaks_expanded = valid_peaks.unsqueeze(0).float()
-    gaussian_sum = torch.sum(torch.exp(-0.5 * ((positions - valid_peaks_expanded) / sigma) ** 2), dim=1)
-    
-    # Normalize to make it a probability distribution
-    if gaussian_sum.sum() > 0:
-        gaussian_sum = gaussian_sum / gaussian_sum.sum()
-    
-    return gaussian_sum
+    @staticmethod
+    def forward(ctx, pred_logits, target_smooth):
+        pred_logits = pred_logits.contiguous(); target_smooth = target_smooth.contiguous()
+        B, n_cols = pred_logits.shape
+        row_loss = torch.empty(B, dtype=torch.float32, device=pred_logits.device)
+        lse = torch.empty(B, dtype=torch.float32, device=pred_logits.device)
+        _fused_kldiv_kernel[(B,)](pred_logits, target_smooth, row_loss, lse, n_cols,
+                                  pred_logits.stride(0), target_smooth.stride(0), BLOCK=triton.next_power_of_2(n_cols))
+        ctx.save_for_backward(pred_logits, target_smooth, lse)
+        return row_loss.sum() / B
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        pred_logits, target_smooth, lse = ctx.saved_tensors
+        target_sum = target_smooth.float().sum(dim=-1, keepdim=True)
+        target_dist = target_smooth.float() / (target_sum + 1e-9)
+        pred_prob = torch.exp(pred_logits.float() - lse.unsqueeze(1))
+        grad_logits = (pred_prob * target_dist.sum(dim=-1, keepdim=True) - target_dist) * (grad_output / pred_logits.shape[0])
+        return grad_logits.to(pred_logits.dtype), None
 
 
-# --- Simplified Combined Loss (Only Main Loss) --- 
 class CombinedLoss(nn.Module):
     def __init__(self, main_loss_type='bce', loss_sigma=1.0, device='cpu'):
         """
@@ -306,6 +719,9 @@ class CombinedLoss(nn.Module):
 
         if self.main_loss_type == 'bce':
             main_loss = self.main_criterion(pred_logits, target_smooth)
+        elif self.main_loss_type == 'kldiv' and triton is not None and pred_logits.is_cuda:
+            # Normalization + log_softmax + KLDiv fused into one kernel
+            main_loss = FusedKLDivLoss.apply(pred_logits, target_smooth)
         elif self.main_loss_type == 'kldiv':
             # Ensure target is a valid probability distribution for KLDiv
             target_dist = target_smooth / (target_smooth.sum(dim=-1, keepdim=True) + 1e-9) # Normalize target
@@ -353,6 +769,32 @@ def create_timestamp_folders(base_data_root=None):
     # Directories will be created after sampling type is known
     return folders, timestamp
 
+# Background pool for figure saving off the training loop (Figure API only: pyplot is not thread-safe)
+_viz_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+atexit.register(_viz_pool.shutdown)
+
+def _save_heatmap(heatmap, path, title):
+    """Renders one (Ns, M+1) log-magnitude heatmap (np.ndarray) to path; runs on _viz_pool."""
+    try:
+        fig = Figure(figsize=(10, 4)); ax = fig.add_subplot()
+        im = ax.imshow(heatmap, aspect='auto', origin='lower', cmap='viridis'); fig.colorbar(im, ax=ax, label='Log Magnitude')
+        ax.set_xlabel('Frequency Unit (M+1)'); ax.set_ylabel('Doppler Unit (Ns)'); ax.set_title(title); fig.tight_layout()
+        fig.savefig(path, dpi=100)
+    except Exception as e: print(f"  Error saving heatmap {path}: {e}", flush=True)
+
+# Single background writer for best-model checkpoints: saves run in submission order, overlapping the next epoch
+_ckpt_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+atexit.register(_ckpt_pool.shutdown)
+
+def _save_checkpoint(state_dict, path):
+    """Saves a CPU state dict to path via a temporary file and atomic rename; runs on _ckpt_pool."""
+    tmp_path = path + '.tmp'
+    try:
+        torch.save(state_dict, tmp_path)
+        os.replace(tmp_path, path) # A crash mid-write never leaves a torn best_model file
+        tqdm.write(f"  Model saved to {path}", file=sys.stdout)
+    except Exception as e: tqdm.write(f"  Error saving model: {e}", file=sys.stdout)
+
 def set_matplotlib_english():
     """Sets Matplotlib parameters for English labels and consistent font sizes."""
     try:
@@ -373,59 +815,41 @@ def count_parameters(model):
 # --- Metric calculation functions ---
 
 # <<< Top-K Accuracy Calculation Function >>> (Handles padding in true_peak_indices_batch)
-def calculate_accuracy_topk(pred_probs, true_peak_indices_batch, k, tolerance):
+def calculate_accuracy_topk(pred_probs, true_peak_indices_batch, k, tolerance, as_tensor=False):
     """
     Calculate target detection accuracy based on Top-K predictions in batch (Recall@TopK, with tolerance).
     Args:
-        pred_probs (torch.Tensor): Model output prediction probabilities (B, M+1).
+        pred_probs (torch.Tensor): Model output prediction probabilities (B, M+1); logits work too (only the ranking is used).
         true_peak_indices_batch (torch.Tensor): True peak indices (B, K_true), may contain padding values (like -1).
         k (int): K value in Top-K.
         tolerance (int): Hit tolerance (number of subcarriers).
+        as_tensor (bool): Return a 0-dim tensor on pred_probs' device instead of a float (no device->host sync).
     Returns:
-        float: Average Top-K hit rate/recall for this batch.
+        float: Average Top-K hit rate/recall for this batch (0-dim tensor if as_tensor).
     """
     batch_size = pred_probs.shape[0]
     M_plus_1 = pred_probs.shape[1]
-    if batch_size == 0:
-        return 0.0 # Or NaN? 0.0 seems reasonable for empty batch
-
-    device = pred_probs.device
-    total_true_peaks_count = 0
-    total_hits = 0
-
     k = min(k, M_plus_1) # Ensure k is not larger than the prediction dimension
-    if k <= 0: return 0.0 # Cannot have non-positive k
+    if batch_size == 0 or k <= 0: # Empty batch or non-positive k
+        return torch.zeros((), device=pred_probs.device) if as_tensor else 0.0
 
     with torch.no_grad():
         # Get the indices of the top k predictions for each sample in the batch
         _, topk_indices_batch = torch.topk(pred_probs, k=k, dim=1) # (B, k)
-
-        for b in range(batch_size):
-            true_indices_b = true_peak_indices_batch[b] # (K_true_padded,)
-            # Filter out invalid true indices (e.g., padding -1)
-            valid_true_mask = (true_indices_b >= 0) & (true_indices_b < M_plus_1)
-            valid_true_peaks = true_indices_b[valid_true_mask] # (num_valid_true,)
-
-            num_true = valid_true_peaks.numel()
-            if num_true == 0:
-                # If a sample has no true peaks, it doesn't contribute to hits or misses
-                continue
-            total_true_peaks_count += num_true
-
-            pred_indices_b_topk = topk_indices_batch[b] # (k,)
-            if pred_indices_b_topk.numel() == 0: # Should not happen if k > 0
-                continue
-
-            # Calculate distance between each true peak and all top-k predicted peaks
-            # Expand dims for broadcasting: (num_valid_true, 1) vs (1, k) -> (num_valid_true, k)
-            dist_matrix = torch.abs(valid_true_peaks.unsqueeze(1) - pred_indices_b_topk.unsqueeze(0))
-
-            # Find the minimum distance from each true peak to *any* of the top-k predictions
-            min_dists_to_topk_preds, _ = torch.min(dist_matrix, dim=1) # (num_valid_true,)
-
-            # A true peak is considered "hit" if its nearest top-k prediction is within the tolerance
-            hits_b = torch.sum(min_dists_to_topk_preds <= tolerance).item()
-            total_hits += hits_b
+        true_indices = true_peak_indices_batch.to(topk_indices_batch.device)
+        # Filter out invalid true indices (e.g., padding -1)
+        valid_true_mask = (true_indices >= 0) & (true_indices < M_plus_1) # (B, K_true)
+
+        # Distance between each true peak and all top-k predicted peaks: (B, K_true, 1) vs (B, 1, k) -> (B, K_true, k)
+        dist_matrix = (true_indices.unsqueeze(2) - topk_indices_batch.unsqueeze(1)).abs()
+        # A true peak is "hit" if its nearest top-k prediction is within the tolerance
+        min_dists_to_topk_preds = dist_matrix.amin(dim=2) # (B, K_true)
+        total_hits = ((min_dists_to_topk_preds <= tolerance) & valid_true_mask).sum()
+        total_true_peaks_count = valid_true_mask.sum()
+        if as_tensor: # 1.0 when the batch has no valid true peaks, as below
+            return torch.where(total_true_peaks_count > 0, total_hits / total_true_peaks_count.clamp(min=1), 1.0)
+        # Single device->host transfer for both counts
+        total_hits, total_true_peaks_count = torch.stack((total_hits, total_true_peaks_count)).tolist()
 
     # Accuracy (Recall@TopK) is defined as the ratio of hits to the total number of VALID true peaks across the batch
     if total_true_peaks_count == 0: # Avoid division by zero if no valid true peaks in the entire batch
@@ -440,8 +864,8 @@ def calculate_accuracy_topk(pred_probs, true_peak_indices_batch, k, tolerance):
 def visualize_predictions(pred_probs_list, target_list, folders, timestamp, M_plus_1,
                           acc_threshold=0.5, acc_tolerance=3, # Tolerance not used here
                           is_target_distribution=False, num_samples=4):
-    """Visualizes a few samples of predictions vs targets."""
-    if not pred_probs_list or not target_list: print("No data to visualize.", flush=True); return
+    """Visualizes a few samples of predictions vs targets (pred_probs_list/target_list: (N, M+1) tensors or lists of rows)."""
+    if len(pred_probs_list) == 0 or len(target_list) == 0: print("No data to visualize.", flush=True); return
     if not folders['figures']: print("Figures directory not set for visualization.", flush=True); return
     num_total_samples = len(pred_probs_list); num_samples = min(num_samples, num_total_samples)
     if num_samples == 0: print("Zero samples requested or available for visualization.", flush=True); return
@@ -469,7 +893,13 @@ def visualize_predictions(pred_probs_list, target_list, folders, timestamp, M_pl
     plot_path = os.path.join(folders['figures'], plot_filename)
     try: plt.savefig(plot_path); print(f"Prediction visualization saved to {plot_path}", flush=True)
     except Exception as e: print(f"Error saving visualization plot: {e}", flush=True)
-    plt.close(fig)
+    fig.clf(); plt.close(fig) # clf drops the axes/artists now instead of at the next GC cycle
+
+
+def amp_dtype_for(device, no_amp=False):
+    """Autocast dtype for the CNN forward pass: bfloat16 where supported, float16 on older CUDA GPUs, None (disabled) otherwise."""
+    if device.type != 'cuda' or no_amp: return None
+    return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
 
 
 # --- Test function ---
@@ -479,8 +909,9 @@ def test_model(model: nn.Module,
                args: argparse.Namespace,
                M_plus_1: int,
                pt_dbm_list_test: List[float], # MODIFIED: Accepts list of dBm values
-               noise_std_dev_tensor: torch.Tensor
-               ) -> Tuple[Dict[float, Dict[str, float]], List[torch.Tensor], List[torch.Tensor]]:
+               noise_std_dev_tensor: torch.Tensor,
+               collect_viz: bool = False
+               ) -> Tuple[Dict[float, Dict[str, float]], torch.Tensor, torch.Tensor]:
     """
     Test model at multiple specified transmit power levels.
 
@@ -492,108 +923,114 @@ def test_model(model: nn.Module,
         M_plus_1: Number of subcarriers + 1.
         pt_dbm_list_test: List of transmit power (dBm) for testing.
         noise_std_dev_tensor: Noise standard deviation tensor.
+        collect_viz: Copy predictions/targets of the first Pt to the CPU for visualization (otherwise returned empty).
 
     Returns:
         Tuple containing:
         - results_per_pt (Dict[float, Dict[str, float]]): Dictionary containing average loss and accuracy for each Pt_dBm.
             Example: {10.0: {'loss': 0.1, 'accuracy': 0.9}, -10.0: {'loss': 0.5, 'accuracy': 0.6}}
-        - all_pred_probs_list (List[torch.Tensor]): (from first Pt) Prediction probability list for visualization.
-        - all_target_smooth_list (List[torch.Tensor]): (from first Pt) Smooth target list for visualization.
+        - all_pred_probs (torch.Tensor): (from first Pt) Prediction probabilities (N, M+1) for visualization, on CPU.
+        - all_target_smooth (torch.Tensor): (from first Pt) Smooth targets (N, M+1) for visualization, on CPU.
     """
     print(f"\nStarting multi-point model testing (loss: {args.loss_type}, Pts_test={pt_dbm_list_test} dBm, MaxTargets={args.max_targets}, TopK={args.top_k})...", flush=True)
     model.eval()
+    eval_model = fuse_conv_bn_for_eval(model) # Conv+BN folded; model keeps its BN layers for further training
+    amp_dtype = amp_dtype_for(device, getattr(args, 'no_amp', False))
 
     # Initialize results structure
     results_per_pt = {pt: {'loss': 0.0, 'accuracy': 0.0, 'count': 0} for pt in pt_dbm_list_test}
 
-    # Lists for visualization (collect from the first power level only for consistency)
+    # Per-batch tensors for visualization (collect from the first power level only for consistency), concatenated at the end
     all_pred_probs_list_viz = []
     all_target_smooth_list_viz = []
-    collect_viz_data = True # Flag to collect only during the first power level iteration
 
     loss_fn = CombinedLoss(main_loss_type=args.loss_type, loss_sigma=args.loss_sigma, device=device)
     print(f"  Accuracy metric: Top-{args.top_k} hit rate @ tolerance={args.accuracy_tolerance}", flush=True)
 
-    with torch.no_grad():
-        # Outer loop for power levels
-        for pt_idx, current_pt_dbm in enumerate(pt_dbm_list_test):
-            print(f"  --- Testing at Pt = {current_pt_dbm:.1f} dBm ---", flush=True)
-            current_pt_linear_mw = 10**(current_pt_dbm / 10.0)
-            current_pt_scaling_factor = math.sqrt(current_pt_linear_mw)
-            current_pt_scaling_factor_tensor = torch.tensor(current_pt_scaling_factor, dtype=torch.float32, device=device)
-
-            test_pbar = tqdm(test_loader, desc=f"Testing Pt={current_pt_dbm:.1f}dBm", leave=False, file=sys.stdout)
-            batch_loss_accum = 0.0
-            batch_acc_accum = 0.0
-            batch_count = 0
-
-            for batch_idx, batch in enumerate(test_pbar):
-                clean_echo = batch['echo'].to(device)
-                # m_peak_targets_original shape is (B, args.max_targets) due to Dataset loading
-                m_peak_targets_original = batch['m_peak'].to(device)
-                batch_size = clean_echo.shape[0]
-
-                # Apply *current fixed* power scaling and noise
-                scaled_echo = clean_echo * current_pt_scaling_factor_tensor # Use current factor
-                noise = (torch.randn_like(scaled_echo.real) + 1j * torch.randn_like(scaled_echo.imag)) * noise_std_dev_tensor.to(device)
-                yecho_input = scaled_echo + noise
-
-                pred_logits, _ = model(yecho_input)
-
-                # Prepare target for loss calculation
-                target_smooth_batch = torch.zeros_like(pred_logits, dtype=torch.float32)
-                for b in range(batch_size):
-                    # peak_indices_b already has shape (args.max_targets,) possibly with -1 padding
-                    peak_indices_b = m_peak_targets_original[b]
-                    # create_gaussian_target handles filtering invalid indices internally
-                    target_smooth_batch[b, :] = create_gaussian_target(peak_indices_b, M_plus_1, args.loss_sigma, device)
+    # All power levels are evaluated in a single pass over the loader: each clean batch is scaled by every
+    # Pt factor and stacked along the batch axis (Pt-major), so data is loaded once instead of once per Pt.
+    num_pts = len(pt_dbm_list_test)
+    pt_scaling_factors = [math.sqrt(10**(pt / 10.0)) for pt in pt_dbm_list_test]
+    noise_std = float(noise_std_dev_tensor)
+    # Per-Pt sums stay on the device; they are read back once after the sweep (and for the progress bar)
+    batch_loss_accum = torch.zeros(num_pts, device=device)
+    batch_acc_accum = torch.zeros(num_pts, device=device)
+    batch_count = torch.zeros(num_pts, device=device)
+    pt_str = '/'.join(f"{pt:.1f}" for pt in pt_dbm_list_test)
+    # Keep one cuFFT plan per (Npt*B, Ns, M+1) shape alive across the sweep (e.g. the smaller last batch)
+    if device.type == 'cuda':
+        plan_cache = torch.backends.cuda.cufft_plan_cache[device.index if device.index is not None else torch.cuda.current_device()]
+        plan_cache.max_size = max(plan_cache.max_size, 32, num_pts)
+
+    # inference_mode (not no_grad): no autograd version-counter/view tracking; Dropout is a no-op in eval()
+    with torch.inference_mode():
+        test_pbar = tqdm(test_loader, desc=f"Testing Pt={pt_str}dBm", leave=False, file=sys.stdout)
+        for batch_idx, batch in enumerate(test_pbar):
+            clean_echo = batch['echo'].to(device, non_blocking=True) # Async H2D from pinned batches
+            # m_peak_targets_original shape is (B, args.max_targets) due to Dataset loading
+            m_peak_targets_original = batch['m_peak'].to(device, non_blocking=True)
+            # Smooth target for loss calculation (precomputed by the dataset)
+            target_smooth_batch = batch['target'].to(device, non_blocking=True).float()
+            batch_size = clean_echo.shape[0]
+
+            # Apply every fixed power scaling at once and add noise: (Npt*B, Ns, M+1), in the model's scratch buffer
+            yecho_input = model.make_noisy_input(clean_echo, pt_scaling_factors, noise_std)
+
+            with torch.autocast(device_type=device.type, dtype=amp_dtype or torch.bfloat16, enabled=amp_dtype is not None):
+                pred_logits_all, _ = eval_model(yecho_input)
+            pred_logits_all = pred_logits_all.float() # Loss and metrics in float32
+            pred_logits_all = pred_logits_all.view(num_pts, batch_size, -1) # (Npt, B, M+1)
+
+            for pt_idx in range(num_pts):
+                pred_logits = pred_logits_all[pt_idx]
 
                 # Calculate loss
                 loss = loss_fn(pred_logits, target_smooth_batch)
-
-                if not (torch.isnan(loss) or torch.isinf(loss)):
-                    batch_loss_accum += loss.item()
+                # NaN/Inf batches are masked out of the sums instead of being checked on the host
+                finite = torch.isfinite(loss)
+                batch_loss_accum[pt_idx] += torch.where(finite, loss, 0.0)
+
+                # Calculate Top-K accuracy metric using args.top_k (sigmoid is monotonic: top-k of logits == top-k of probabilities)
+                accuracy = calculate_accuracy_topk(
+                    pred_logits,
+                    m_peak_targets_original, # Pass the original labels (B, max_targets)
+                    k=args.top_k,
+                    tolerance=args.accuracy_tolerance,
+                    as_tensor=True
+                )
+                batch_acc_accum[pt_idx] += torch.where(finite, accuracy, 0.0)
+                batch_count[pt_idx] += finite
+
+                # Store results for visualization (only for the first power level)
+                if collect_viz and pt_idx == 0:
                     # Convert logits to probabilities (e.g., using sigmoid for BCE-like interpretation)
-                    pred_probs = torch.sigmoid(pred_logits)
-
-                    # Calculate Top-K accuracy metric using args.top_k
-                    accuracy = calculate_accuracy_topk(
-                        pred_probs,
-                        m_peak_targets_original, # Pass the original labels (B, max_targets)
-                        k=args.top_k,
-                        tolerance=args.accuracy_tolerance
-                    )
-                    batch_acc_accum += accuracy
-                    batch_count += 1
-
-                    # Store results for visualization (only for the first power level)
-                    if collect_viz_data:
-                        all_pred_probs_list_viz.extend(list(pred_probs.cpu()))
-                        all_target_smooth_list_viz.extend(list(target_smooth_batch.cpu()))
-
-                    # Update TQDM postfix
-                    if batch_idx % 50 == 0 or batch_idx == len(test_loader) - 1:
-                         postfix_dict = {'L': f"{loss.item():.4f}", f'Top{args.top_k}Hit': f"{accuracy:.3f}"}
-                         test_pbar.set_postfix(postfix_dict)
-                else:
-                    print(f"Warning: NaN/Inf loss encountered in test batch {batch_idx} (Pt={current_pt_dbm:.1f}dBm).", flush=True)
-                    if batch_idx % 50 == 0 or batch_idx == len(test_loader) - 1:
-                        test_pbar.set_postfix({'loss': "NaN"})
-
-            # Calculate average results for the current power level
-            if batch_count > 0:
-                results_per_pt[current_pt_dbm]['loss'] = batch_loss_accum / batch_count
-                results_per_pt[current_pt_dbm]['accuracy'] = batch_acc_accum / batch_count
-                results_per_pt[current_pt_dbm]['count'] = batch_count
-                print(f"    Pt={current_pt_dbm:.1f}dBm - Avg Loss: {results_per_pt[current_pt_dbm]['loss']:.4f}, Avg Top-{args.top_k} Hit: {results_per_pt[current_pt_dbm]['accuracy']:.4f}", flush=True)
-            else:
-                results_per_pt[current_pt_dbm]['loss'] = float('inf')
-                results_per_pt[current_pt_dbm]['accuracy'] = 0.0
-                results_per_pt[current_pt_dbm]['count'] = 0
-                print(f"    Pt={current_pt_dbm:.1f}dBm - No valid batches for evaluation.", flush=True)
-
-            # Stop collecting visualization data after the first power level
-            collect_viz_data = False
+                    all_pred_probs_list_viz.append(torch.sigmoid(pred_logits).to('cpu', non_blocking=True))
+                    all_target_smooth_list_viz.append(target_smooth_batch.to('cpu', non_blocking=True))
+
+            # Update TQDM postfix (running averages per Pt; the only sync inside the loop)
+            if batch_idx % 50 == 0 or batch_idx == len(test_loader) - 1:
+                 running = (torch.stack((batch_loss_accum, batch_acc_accum)) / batch_count.clamp(min=1)).tolist()
+                 postfix_dict = {'L': '/'.join(f"{v:.4f}" for v in running[0]), f'Top{args.top_k}Hit': '/'.join(f"{v:.3f}" for v in running[1])}
+                 test_pbar.set_postfix(postfix_dict)
+
+    num_batches = len(test_loader)
+    batch_loss_accum, batch_acc_accum, batch_count = torch.stack((batch_loss_accum, batch_acc_accum, batch_count)).tolist()
+    batch_count = [int(c) for c in batch_count]
+
+    # Calculate average results for each power level
+    for pt_idx, current_pt_dbm in enumerate(pt_dbm_list_test):
+        if batch_count[pt_idx] < num_batches:
+            print(f"Warning: {num_batches - batch_count[pt_idx]} test batch(es) with NaN/Inf loss skipped (Pt={current_pt_dbm:.1f}dBm).", flush=True)
+        if batch_count[pt_idx] > 0:
+            results_per_pt[current_pt_dbm]['loss'] = batch_loss_accum[pt_idx] / batch_count[pt_idx]
+            results_per_pt[current_pt_dbm]['accuracy'] = batch_acc_accum[pt_idx] / batch_count[pt_idx]
+            results_per_pt[current_pt_dbm]['count'] = batch_count[pt_idx]
+            print(f"    Pt={current_pt_dbm:.1f}dBm - Avg Loss: {results_per_pt[current_pt_dbm]['loss']:.4f}, Avg Top-{args.top_k} Hit: {results_per_pt[current_pt_dbm]['accuracy']:.4f}", flush=True)
+        else:
+            results_per_pt[current_pt_dbm]['loss'] = float('inf')
+            results_per_pt[current_pt_dbm]['accuracy'] = 0.0
+            results_per_pt[current_pt_dbm]['count'] = 0
+            print(f"    Pt={current_pt_dbm:.1f}dBm - No valid batches for evaluation.", flush=True)
 
 
     print("\nMulti-point test results summary:", flush=True)
@@ -603,10 +1040,12 @@ def test_model(model: nn.Module,
         print(f"    Average Top-{args.top_k} hit rate/recall (Recall@Top{args.top_k}, Tol={args.accuracy_tolerance}): {results['accuracy']:.4f}")
         print(f"    Valid batches: {results['count']}")
 
-    gc.collect();
-    if torch.cuda.is_available(): torch.cuda.empty_cache()
+    del eval_model
 
-    return results_per_pt, all_pred_probs_list_viz, all_target_smooth_list_viz
+    if torch.cuda.is_available(): torch.cuda.synchronize() # Complete the non_blocking D2H copies before reading them
+    all_pred_probs_viz = torch.cat(all_pred_probs_list_viz) if all_pred_probs_list_viz else torch.empty((0, M_plus_1))
+    all_target_smooth_viz = torch.cat(all_target_smooth_list_viz) if all_target_smooth_list_viz else torch.empty((0, M_plus_1))
+    return results_per_pt, all_pred_probs_viz, all_target_smooth_viz
 
 
 # --- Main execution function ---
@@ -619,6 +1058,11 @@ def main():
     parser.add_argument('--lr', type=float, default=1e-4, help='Learning rate for model (CNN)')
     parser.add_argument('--weight_decay', type=float, default=1e-5, help='Weight decay for model (CNN)')
     parser.add_argument('--clip_grad_norm', type=float, default=5.0, help='Gradient clipping norm upper limit for model (CNN)')
+    parser.add_argument('--no_amp', action='store_true', help='Disable autocast (bfloat16, or float16 with GradScaler) of the CNN forward pass on CUDA')
+    parser.add_argument('--no_compile', action='store_true', help='Disable torch.compile of the CNN training forward pass on CUDA')
+    parser.add_argument('--debug_print_every', type=int, default=100, help='Print per-sample Top-K predictions every N training batches (0: off)')
+    parser.add_argument('--empty_cache_every_n_epochs', type=int, default=0, help='Release cached CUDA memory every N epochs (0: never during training)')
+    parser.add_argument('--gc_every_n_epochs', type=int, default=0, help='Run a full Python gc.collect() every N epochs, for debugging reference cycles (0: never during training)')
     parser.add_argument('--patience', type=int, default=7, help='Early stopping patience (based on loss from lowest validation power)')
     # --- System/Data Parameters ---
     parser.add_argument('--data_dir', type=str, default=None, help='Data root directory path containing echoes/ and *.npz files')
@@ -638,6 +1082,7 @@ def main():
     # --- Loss/Accuracy Parameters ---
     parser.add_argument('--loss_type', type=str, default='bce', choices=['bce', 'kldiv'], help='Main loss function type')
     parser.add_argument('--loss_sigma', type=float, default=1.0, help='Standard deviation for Gaussian smooth target (used for target generation in BCE)')
+    parser.add_argument('--gauss_method', type=str, default='sparse', choices=['sparse', 'dense'], help='Smooth target construction: sparse (Gaussian window around each peak) or dense (full grid, reference)')
 
     parser.add_argument('--top_k', type=int, default=4, help='Number of Top-K predictions for accuracy calculation (recommended to set to --max_targets value)')
     # ---
@@ -645,6 +1090,7 @@ def main():
     parser.add_argument('--accuracy_tolerance', type=int, default=3, help='Tolerance (number of subcarriers) when calculating Top-K accuracy (hit rate)')
     # --- Execution Control ---
     parser.add_argument('--num_workers', type=int, default=4, help='Number of worker processes for data loader')
+    parser.add_argument('--shuffle_chunks_per_group', type=int, default=1, help='Number of echo chunks shuffled together when forming training batches (higher = more shuffling, less chunk reuse)')
     parser.add_argument('--cuda_device', type=int, default=0, help="CUDA device ID to use (if available)")
     parser.add_argument('--test_only', action='store_true', help='Only run testing on loaded model')
     parser.add_argument('--load_model', action='store_true', help='Try to load best model (if exists in model_dir or specified path)')
@@ -665,6 +1111,7 @@ def main():
     # Determine the critical power level for early stopping (lowest one)
     critical_val_pt_dbm = min(args.val_pt_dbm_list)
     print(f"Early stopping will be based on validation loss at lowest power point: {critical_val_pt_dbm:.1f} dBm")
+    loss_name = args.loss_type.upper() # Loss display name for logs, plot labels and the summary
 
     # --- Sanity check/recommendation for top_k ---
     if args.top_k != args.max_targets:
@@ -687,6 +1134,12 @@ def main():
         device = torch.device("cpu")
         print("CUDA not available or not requested. Using CPU.", flush=True)
     print(f"Using device: {device}", flush=True)
+    if device.type == 'cuda':
+        # Input shapes are fixed (train batches use drop_last), so cuDNN autotunes each conv once; TF32 for float32 conv/matmul
+        torch.backends.cudnn.benchmark = True
+        torch.backends.cudnn.allow_tf32 = True
+        torch.backends.cuda.matmul.allow_tf32 = True
+    plt.switch_backend('Agg') # Figures are only saved to files: no GUI canvas
     set_matplotlib_english()
 
     try: data_root = args.data_dir if args.data_dir else get_latest_experiment_path()
@@ -761,11 +1214,13 @@ def main():
     print("Setting up datasets and data loaders...", flush=True)
     try:
         traj_path_check = os.path.join(data_root, 'trajectory_data.npz')
-        traj_data_check = np.load(traj_path_check)
-        key_to_check = 'm_peak_indices' if 'm_peak_indices' in traj_data_check else 'm_peak'
-        num_total_data_available = traj_data_check[key_to_check].shape[0]
+        with np.load(traj_path_check) as traj_data_check:
+            key_to_check = 'm_peak_indices' if 'm_peak_indices' in traj_data_check.files else 'm_peak'
+        # Read the shape from the .npy header instead of loading the array
+        m_peak_shape_check = npz_array_shape(traj_path_check, key_to_check)
+        num_total_data_available = m_peak_shape_check[0]
         # Get actual K dimension from loaded data if possible
-        actual_K_dim_data = traj_data_check[key_to_check].shape[1] if traj_data_check[key_to_check].ndim > 1 else 1
+        actual_K_dim_data = m_peak_shape_check[1] if len(m_peak_shape_check) > 1 else 1
         print(f"  Detected {num_total_data_available} total samples in trajectory_data.npz, K dimension={actual_K_dim_data}.")
     except Exception as e:
         print(f"Warning: Cannot determine total sample count or K dimension from trajectory_data.npz ({e}). Using default 50000 for split.")
@@ -781,23 +1236,34 @@ def main():
 
     try:
         # --- Use args.max_targets for expected_k ---
-        test_dataset = ChunkedEchoDataset(data_root, test_start_idx, test_end_idx, expected_k=args.max_targets)
-        val_dataset = ChunkedEchoDataset(data_root, val_start_idx, val_end_idx, expected_k=args.max_targets)
-        train_dataset = ChunkedEchoDataset(data_root, train_start_idx, train_end_idx, expected_k=args.max_targets)
+        test_dataset = ChunkedEchoDataset(data_root, test_start_idx, test_end_idx, expected_k=args.max_targets, target_sigma=args.loss_sigma, target_method=args.gauss_method)
+        val_dataset = ChunkedEchoDataset(data_root, val_start_idx, val_end_idx, expected_k=args.max_targets, target_sigma=args.loss_sigma, target_method=args.gauss_method)
+        train_dataset = ChunkedEchoDataset(data_root, train_start_idx, train_end_idx, expected_k=args.max_targets, target_sigma=args.loss_sigma, target_method=args.gauss_method)
         # ---
     except Exception as e: print(f"Error creating datasets: {e}", flush=True); traceback.print_exc(); return
 
     print(f"Actual dataset lengths: Train={len(train_dataset)}, Val={len(val_dataset)}, Test={len(test_dataset)}")
     pin_memory=(device.type == 'cuda') # More robust check for CUDA
-    train_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, pin_memory=pin_memory, drop_last=True)
-    val_loader = DataLoader(val_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=pin_memory)
-    test_loader = DataLoader(test_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, pin_memory=pin_memory)
+    train_loader = make_loader(train_dataset, args.batch_size, training=True, num_workers=args.num_workers, pin_memory=pin_memory, chunks_per_group=args.shuffle_chunks_per_group)
+    val_loader = make_loader(val_dataset, args.batch_size, training=False, num_workers=args.num_workers, pin_memory=pin_memory)
+    test_loader = make_loader(test_dataset, args.batch_size, training=False, num_workers=args.num_workers, pin_memory=pin_memory)
+    print(f"  DataLoader workers: {train_loader.num_workers} (persistent: {train_loader.persistent_workers})")
 
 
     # --- Build Model ---
     print("Building model (IndexPredictionCNN)...", flush=True)
     model = IndexPredictionCNN(M_plus_1, Ns, args.hidden_dim, args.dropout).to(device)
+    if device.type == 'cuda':
+        model = model.to(memory_format=torch.channels_last) # Conv2d weights in NHWC to match the inputs
+        print(f"Conv2d weights channels_last: {model.feature_extractor[3].weight.is_contiguous(memory_format=torch.channels_last)}", flush=True)
     print(f"Model parameter count: {count_parameters(model)}", flush=True)
+    # Mixed precision (autocast) for the training forward pass; loss is computed in float32.
+    # float16 (GPUs without bfloat16) needs loss scaling, bfloat16 does not.
+    amp_dtype = amp_dtype_for(device, args.no_amp)
+    use_amp = amp_dtype is not None
+    grad_scaler = torch.amp.GradScaler('cuda', enabled=amp_dtype == torch.float16)
+    print(f"Mixed precision training (autocast): {str(amp_dtype).replace('torch.', '') if use_amp else 'disabled'}"
+          f"{' with GradScaler' if grad_scaler.is_enabled() else ''}", flush=True)
 
     # --- Load Pretrained Model Logic ---
     load_path = None
@@ -806,24 +1272,13 @@ def main():
         load_path = args.load_model_path
         # Try finding model in model_dir if load_model_path is not specified
         if not load_path and args.model_dir:
-            potential_paths = []
-            if os.path.isdir(args.model_dir): # Check if directory exists
-                 potential_paths = [f for f in os.listdir(args.model_dir) if f.startswith('best_model') and f.endswith('.pt')]
-            if potential_paths:
-                 # Sort by modification time, newest first
-                 potential_paths.sort(key=lambda x: os.path.getmtime(os.path.join(args.model_dir, x)), reverse=True)
-                 load_path = os.path.join(args.model_dir, potential_paths[0])
-                 print(f"  Found latest model in model_dir: {load_path}")
-            else:
-                 # Fallback to check for 'best_model.pt' specifically
-                 potential_path_exact = os.path.join(args.model_dir, 'best_model.pt')
-                 if os.path.exists(potential_path_exact):
-                         load_path = potential_path_exact
-                         print(f"  Found model in model_dir: {load_path}")
+            # Newest best_model*.pt (this also covers a plain best_model.pt)
+            load_path = find_latest_model(args.model_dir)
+            if load_path: print(f"  Found latest model in model_dir: {load_path}")
         # Try loading if a path was found or specified
         if load_path and os.path.exists(load_path):
             try:
-                 model.load_state_dict(torch.load(load_path, map_location=device));
+                 model.load_state_dict(torch.load(load_path, map_location='cpu', weights_only=True));
                  print(f"  Loaded model state dict from: {load_path}", flush=True)
             except Exception as e: print(f"  Warning: Failed to load model state dict {load_path}: {e}", flush=True); load_path = None
         elif args.load_model or args.load_model_path or args.model_dir: # Only warn if user intended to load
@@ -840,14 +1295,14 @@ def main():
         test_results_per_pt, all_probs, all_targets_smooth = test_model(
             model, test_loader, device, args, M_plus_1,
             args.val_pt_dbm_list, # Use the specified list of powers
-            noise_std_dev_tensor
+            noise_std_dev_tensor, collect_viz=True
         )
         # ---
         print("\n===== Test-Only Results =====")
         # Print results for each tested power
         for pt, results in test_results_per_pt.items():
             print(f"--- Pt = {pt:.1f} dBm ---")
-            print(f"  Loss ({args.loss_type.upper()}): {results['loss']:.4f}")
+            print(f"  Loss ({loss_name}): {results['loss']:.4f}")
             print(f"  Top-{args.top_k} hit rate/recall: {results['accuracy']:.4f}")
         visualize_predictions(all_probs, all_targets_smooth, folders, timestamp + "_test_only", M_plus_1,
                               acc_threshold=args.accuracy_threshold,
@@ -861,16 +1316,23 @@ def main():
     print(f"Scheduler: CosineAnnealingLR (T_max={args.epochs})", flush=True)
     scheduler = CosineAnnealingLR(optimizer, T_max=args.epochs, eta_min=max(1e-8, args.lr * 0.001))
     print(f"Gradient clipping norm: {args.clip_grad_norm}", flush=True)
+    # Compiled training forward (fixed shapes: dynamic=False). `model` itself stays uncompiled, so state_dict keys,
+    # checkpoint loading and test_model (which evaluates a Conv+BN-fused copy) are unaffected.
+    use_compile = device.type == 'cuda' and not args.no_compile and hasattr(torch, 'compile')
+    train_forward = torch.compile(model, dynamic=False) if use_compile else model
+    print(f"torch.compile for training: {'enabled' if use_compile else 'disabled'}", flush=True)
 
     # --- Loss Function ---
     criterion = CombinedLoss(main_loss_type=args.loss_type, loss_sigma=args.loss_sigma, device=device)
-    print(f"Using loss function: {args.loss_type.upper()} (Sigma={args.loss_sigma})")
+    print(f"Using loss function: {loss_name} (Sigma={args.loss_sigma})")
 
     # --- Training Loop Initialization ---
     epochs = args.epochs; best_val_loss = float('inf'); early_stop_counter = 0
-    train_losses, val_losses_hist = [], {pt: [] for pt in args.val_pt_dbm_list} # Store val loss per pt
-    train_acc_hist, val_acc_hist = [], {pt: [] for pt in args.val_pt_dbm_list} # Store val acc per pt
-    model_save_path = "" ; saved_heatmap_count = 0
+    # Per-epoch histories, preallocated (NaN = not run); only the first epochs_run entries are valid
+    train_losses, val_losses_hist = np.full(epochs, np.nan), {pt: np.full(epochs, np.nan) for pt in args.val_pt_dbm_list} # Store val loss per pt
+    train_acc_hist, val_acc_hist = np.full(epochs, np.nan), {pt: np.full(epochs, np.nan) for pt in args.val_pt_dbm_list} # Store val acc per pt
+    epochs_run = 0
+    model_save_path = "" ; saved_heatmap_count = 0; pending_checkpoint = None
     snr_calculated = False; avg_snr_db_references = {} # Reference SNRs for each val power
 
     # Calculate min/max linear power for training sampling
@@ -879,183 +1341,174 @@ def main():
 
     # --- Training Loop ---
     print(f"\nStarting training (random power [{args.min_pt_dbm}dBm, {args.max_pt_dbm}dBm], sampling: {args.power_sampling}) for {epochs} epochs...", flush=True)
+    # Reused device buffers for the smooth targets (train batches are all full-size: drop_last). The float16 rows are
+    # copied as-is and cast on the device: a cross-device float16->float32 copy_ converts through a temporary every batch
+    target_half_buf = torch.empty((args.batch_size, M_plus_1), dtype=torch.float16, device=device)
+    target_smooth_buf = torch.empty((args.batch_size, M_plus_1), dtype=torch.float32, device=device)
     epoch_pbar = tqdm(range(epochs), desc="Overall Progress", file=sys.stdout)
 
     for epoch in epoch_pbar:
         # =================== Training Phase (with Random Power) ===================
         model.train()
-        epoch_train_loss = 0.0
-        epoch_train_topk_accuracy_sum = 0.0; train_acc_batches = 0
+        # Loss/accuracy sums stay on the device; read back once per epoch (and at progress-bar updates)
+        epoch_train_loss = torch.zeros((), device=device)
+        epoch_train_topk_accuracy_sum = torch.zeros((), device=device); train_acc_batches = 0
         train_batch_count = 0; nan_skipped_count = 0
         train_pbar = tqdm(train_loader, desc=f"Epoch {epoch+1}/{epochs} [Training]", leave=False, file=sys.stdout)
+        # Random transmit power of every batch of this epoch, drawn at once (MODIFIED SAMPLING: linear mW or dBm)
+        if args.power_sampling == 'linear':
+            # Sample uniformly in linear scale (mW)
+            epoch_pt_linear_mw = np.random.uniform(min_pt_linear_mw_train, max_pt_linear_mw_train, size=len(train_loader))
+            epoch_pt_dbm_for_log = 10 * np.log10(epoch_pt_linear_mw + 1e-9) # For logging only
+        else: # args.power_sampling == 'dbm'
+            # Sample uniformly in dBm scale
+            epoch_pt_dbm_for_log = np.random.uniform(args.min_pt_dbm, args.max_pt_dbm, size=len(train_loader))
+            epoch_pt_linear_mw = 10**(epoch_pt_dbm_for_log / 10.0)
+        epoch_pt_scaling_factors = np.sqrt(epoch_pt_linear_mw).tolist() # Python floats for make_noisy_input
+        epoch_pt_dbm_for_log = epoch_pt_dbm_for_log.tolist()
 
         for batch_idx, batch in enumerate(train_pbar):
-            clean_echo = batch['echo'].to(device)
-            m_peak_targets_original = batch['m_peak'].to(device) # Shape (B, args.max_targets)
+            clean_echo = batch['echo'].to(device, non_blocking=True) # Async H2D from pinned batches
+            m_peak_targets_original = batch['m_peak'].to(device, non_blocking=True) # Shape (B, args.max_targets)
+            # Smooth target for loss: precomputed float16 rows of the dataset's shared target table, no per-step construction
+            if batch['target'].shape == target_smooth_buf.shape: # Async H2D copy into the float16 staging buffer, then the cast on the device
+                target_smooth_batch = target_smooth_buf.copy_(target_half_buf.copy_(batch['target'], non_blocking=True))
+            else: target_smooth_batch = batch['target'].to(device, non_blocking=True).float()
             batch_size = clean_echo.shape[0]
-            optimizer.zero_grad()
-
-            # --- START: Random Power Scaling for this Batch (MODIFIED SAMPLING) ---
-            if args.power_sampling == 'linear':
-                # Sample uniformly in linear scale (mW)
-                current_pt_linear_mw = np.random.uniform(min_pt_linear_mw_train, max_pt_linear_mw_train)
-                current_pt_dbm_for_log = 10 * math.log10(current_pt_linear_mw + 1e-9) # For logging only
-            else: # args.power_sampling == 'dbm'
-                # Sample uniformly in dBm scale
-                current_pt_dbm_for_log = np.random.uniform(args.min_pt_dbm, args.max_pt_dbm)
-                current_pt_linear_mw = 10**(current_pt_dbm_for_log / 10.0)
-
-            current_pt_scaling_factor = math.sqrt(current_pt_linear_mw)
-            current_pt_scaling_factor_tensor = torch.tensor(current_pt_scaling_factor, dtype=torch.float32, device=device)
-            scaled_echo = clean_echo * current_pt_scaling_factor_tensor
-            # --- END: Random Power Scaling for this Batch ---
+            optimizer.zero_grad(set_to_none=True) # Drop grad tensors instead of memsetting them
 
-            noise = (torch.randn_like(scaled_echo.real) + 1j * torch.randn_like(scaled_echo.imag)) * noise_std_dev_tensor.to(device)
-            yecho_input = scaled_echo + noise
+            # --- START: Random Power Scaling for this Batch (pre-drawn for the epoch) ---
+            current_pt_scaling_factor = epoch_pt_scaling_factors[batch_idx]
+            current_pt_dbm_for_log = epoch_pt_dbm_for_log[batch_idx]
+            # Scaling + noise are written in place into the model's scratch buffer
+            yecho_input = model.make_noisy_input(clean_echo, [current_pt_scaling_factor], noise_std_dev)
+            # --- END: Random Power Scaling for this Batch ---
 
             # Calculate reference SNRs once (using fixed validation powers)
             if not snr_calculated and batch_idx == 0 and epoch == 0:
                 print("\n--- Reference Signal-to-Noise Ratios (based on fixed validation power points) ---", flush=True)
-                noise_power_watts_theoretic = 2 * (noise_std_dev_tensor**2)
-                print(f"  Theoretical noise power: {noise_power_watts_theoretic.item():.3e} W", flush=True)
-                with torch.no_grad():
-                    for ref_pt_dbm in args.val_pt_dbm_list:
-                         ref_pt_linear_mw = 10**(ref_pt_dbm / 10.0)
-                         ref_scaling_factor = math.sqrt(ref_pt_linear_mw)
-                         ref_scaling_factor_tensor = torch.tensor(ref_scaling_factor, dtype=torch.float32, device=device)
-                         scaled_echo_reference = clean_echo * ref_scaling_factor_tensor
-                         signal_power_watts = (scaled_echo_reference.real**2 + scaled_echo_reference.imag**2).mean(dim=(1,2), keepdim=True)
-                         snr_per_sample = signal_power_watts / (noise_power_watts_theoretic + 1e-20)
-                         avg_snr_linear_reference = torch.mean(snr_per_sample).item()
-                         avg_snr_db_reference = 10 * math.log10(avg_snr_linear_reference) if avg_snr_linear_reference > 1e-20 else -float('inf')
-                         avg_snr_db_references[ref_pt_dbm] = avg_snr_db_reference
-                         print(f"  Pt={ref_pt_dbm:.1f} dBm -> Avg Signal Power: {torch.mean(signal_power_watts).item():.3e} W, Avg SNR: {avg_snr_db_reference:.2f} dB", flush=True)
+                noise_power_watts_theoretic = 2 * noise_std_dev**2 # Python floats: no host tensors mixed into device ops
+                print(f"  Theoretical noise power: {noise_power_watts_theoretic:.3e} W", flush=True)
+                with torch.inference_mode():
+                    # Signal power scales with Pt (|sqrt(Pt) * s|^2), so the clean-echo power is reduced once
+                    clean_signal_power_watts = torch.view_as_real(clean_echo).square().sum(dim=-1).mean().item()
+                for ref_pt_dbm in args.val_pt_dbm_list:
+                     ref_pt_linear_mw = 10**(ref_pt_dbm / 10.0)
+                     signal_power_watts = clean_signal_power_watts * ref_pt_linear_mw
+                     avg_snr_linear_reference = signal_power_watts / (noise_power_watts_theoretic + 1e-20)
+                     avg_snr_db_reference = 10 * math.log10(avg_snr_linear_reference) if avg_snr_linear_reference > 1e-20 else -float('inf')
+                     avg_snr_db_references[ref_pt_dbm] = avg_snr_db_reference
+                     print(f"  Pt={ref_pt_dbm:.1f} dBm -> Avg Signal Power: {signal_power_watts:.3e} W, Avg SNR: {avg_snr_db_reference:.2f} dB", flush=True)
                 print("  Note: Actual training SNR will vary based on random power.", flush=True)
                 print("--------------------------------------\n", flush=True)
                 snr_calculated = True
 
-            pred_logits, Y_magnitude_log = model(yecho_input)
+            with torch.autocast(device_type=device.type, dtype=amp_dtype or torch.bfloat16, enabled=use_amp):
+                pred_logits, Y_magnitude_log = train_forward(yecho_input)
+            pred_logits = pred_logits.float() # Keep the loss and metrics in float32
 
-            # Save heatmaps (optional - unchanged logic)
+            # Save heatmaps (optional): one device->host copy, rendering/saving runs on _viz_pool
             if saved_heatmap_count < 10 and epoch == 0 :
-                B_current = Y_magnitude_log.shape[0]
-                for i in range(B_current):
-                    if saved_heatmap_count < 10:
-                         heatmap_tensor = Y_magnitude_log[i].detach().cpu()
-                         try:
-                              plt.figure(figsize=(10, 4)); plt.imshow(heatmap_tensor.numpy(), aspect='auto', origin='lower', cmap='viridis'); plt.colorbar(label='Log Magnitude'); plt.xlabel('Frequency Unit (M+1)'); plt.ylabel('Doppler Unit (Ns)'); plt.title(f'Log Magnitude Spectrum Heatmap (Sample {saved_heatmap_count}, Train Pt={current_pt_dbm_for_log:.1f}dBm)'); plt.tight_layout(); # Added Pt to title
-                              heatmap_filename = f'heatmap_input_sample_{saved_heatmap_count}_{timestamp}.png'; heatmap_path = os.path.join(folders['figures'], heatmap_filename); plt.savefig(heatmap_path, dpi=100); plt.close()
-                         except Exception as e: print(f"  Error saving heatmap sample {saved_heatmap_count}: {e}", flush=True)
-                         finally: saved_heatmap_count += 1
-                    else: break
-
-
-            # Prepare target for loss
-            target_smooth_batch = torch.zeros_like(pred_logits, dtype=torch.float32)
-            valid_peaks_per_sample_list_print = [] # For detailed print only
-            for b in range(batch_size):
-                peak_indices_b = m_peak_targets_original[b] # Shape (max_targets,)
-                target_smooth_batch[b, :] = create_gaussian_target(peak_indices_b, M_plus_1, args.loss_sigma, device)
-                # Store valid peaks for the detailed printout
-                valid_peaks_mask = (peak_indices_b >= 0) & (peak_indices_b < M_plus_1)
-                valid_peaks = peak_indices_b[valid_peaks_mask]
-                valid_peaks_per_sample_list_print.append(valid_peaks.clone())
+                heatmaps = Y_magnitude_log[:10 - saved_heatmap_count].detach().float().cpu().numpy()
+                for heatmap in heatmaps:
+                    heatmap_filename = f'heatmap_input_sample_{saved_heatmap_count}_{timestamp}.png'; heatmap_path = os.path.join(folders['figures'], heatmap_filename)
+                    _viz_pool.submit(_save_heatmap, heatmap, heatmap_path, f'Log Magnitude Spectrum Heatmap (Sample {saved_heatmap_count}, Train Pt={current_pt_dbm_for_log:.1f}dBm)')
+                    saved_heatmap_count += 1
 
             # Calculate loss
             loss = criterion(pred_logits, target_smooth_batch)
 
-            if torch.isnan(loss) or torch.isinf(loss):
-                tqdm.write(f"\nWarning (epoch {epoch+1}, train batch {batch_idx}): Loss NaN/Inf. Skipping update.", file=sys.stdout); nan_skipped_count += 1; optimizer.zero_grad(); continue
+            if not torch.isfinite(loss): # The only per-batch host sync: needed to skip the update
+                tqdm.write(f"\nWarning (epoch {epoch+1}, train batch {batch_idx}): Loss NaN/Inf. Skipping update.", file=sys.stdout); nan_skipped_count += 1; continue
 
-            loss.backward()
-            if args.clip_grad_norm > 0: torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
-            optimizer.step()
+            grad_scaler.scale(loss).backward() # Plain backward unless float16 autocast is active
+            if args.clip_grad_norm > 0:
+                grad_scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.clip_grad_norm)
+            grad_scaler.step(optimizer)
+            grad_scaler.update()
 
             # --- Accumulate Metrics ---
-            pred_probs_detached = torch.sigmoid(pred_logits.detach())
+            pred_scores_detached = pred_logits.detach() # Top-K only needs the ranking, so no sigmoid
             batch_accuracy = calculate_accuracy_topk(
-                pred_probs_detached, m_peak_targets_original, k=args.top_k, tolerance=args.accuracy_tolerance
+                pred_scores_detached, m_peak_targets_original, k=args.top_k, tolerance=args.accuracy_tolerance, as_tensor=True
             )
-            epoch_train_loss += loss.item()
+            epoch_train_loss += loss.detach()
             epoch_train_topk_accuracy_sum += batch_accuracy; train_acc_batches += 1
             train_batch_count += 1
 
             # --- TQDM Update ---
             if batch_idx % 50 == 0 or batch_idx == len(train_loader) - 1:
-                 postfix_dict = {'Pt': f"{current_pt_dbm_for_log:.1f}", 'L': f"{loss.item():.3f}", f'Top{args.top_k}Hit': f"{batch_accuracy:.2f}"}
-                 train_pbar.set_postfix(postfix_dict)
+                 loss_value, accuracy_value = torch.stack((loss.detach(), batch_accuracy)).tolist() # One sync per update
+                 train_pbar.set_postfix_str(f"Pt={current_pt_dbm_for_log:.1f}, L={loss_value:.3f}, Top{args.top_k}Hit={accuracy_value:.2f}")
 
             # --- Detailed Print --- 
-            if batch_idx > 0 and batch_idx % 100 == 0: # Reduced frequency
-                 tqdm.write("-" * 20, file=sys.stdout)
-                 with torch.no_grad():
+            if args.debug_print_every > 0 and batch_idx > 0 and batch_idx % args.debug_print_every == 0: # Reduced frequency
+                 debug_lines = ["-" * 20]
+                 with torch.inference_mode():
                       num_samples_to_print = min(2, batch_size) # Reduced number
+                      # --- Use args.top_k for k_top_print ---
+                      k_top_print = min(args.top_k, pred_scores_detached.shape[1])
+                      # ---
+                      # Hits of all printed samples in one broadcast: (S, K_true, 1) vs (S, 1, k)
+                      topk_indices_sorted_print = torch.topk(pred_scores_detached[:num_samples_to_print], k=k_top_print, dim=1).indices.sort(dim=1).values
+                      true_peaks_print = m_peak_targets_original[:num_samples_to_print] # (S, max_targets), -1 padded
+                      valid_true_print = (true_peaks_print >= 0) & (true_peaks_print < M_plus_1)
+                      min_dists_print = (true_peaks_print.unsqueeze(2) - topk_indices_sorted_print.unsqueeze(1)).abs().amin(dim=2)
+                      hits_topk_print = ((min_dists_print <= args.accuracy_tolerance) & valid_true_print).sum(dim=1)
+                      # Single device->host transfer for everything printed below: [top-k | true peaks (-1 if invalid) | hits] per row
+                      print_rows = torch.cat((topk_indices_sorted_print, torch.where(valid_true_print, true_peaks_print, -1), hits_topk_print.unsqueeze(1)), dim=1).tolist()
                       for s in range(num_samples_to_print):
-                           # --- Use args.top_k for k_top_print ---
-                           k_top_print = min(args.top_k, pred_probs_detached.shape[1])
-                           # ---
-                           _, topk_indices_print = torch.topk(pred_probs_detached[s], k=k_top_print)
-                           topk_indices_sorted_print, _ = torch.sort(topk_indices_print)
-                           pred_peaks_str = np.array2string(topk_indices_sorted_print.cpu().numpy(), precision=0, separator=',', max_line_width=100).replace('\n', '')
-
-                           sample_true_peaks_print = valid_peaks_per_sample_list_print[s]
-                           true_pks_s_list = [p.item() for p in sample_true_peaks_print]
-                           true_peaks_str = np.array2string(np.sort(np.array(true_pks_s_list)), precision=0, separator=',', max_line_width=100).replace('\n', '')
+                           pred_peaks_list, true_peaks_row, hits_s_topk_print = print_rows[s][:k_top_print], print_rows[s][k_top_print:-1], print_rows[s][-1]
+                           pred_peaks_str = "[" + ",".join(map(str, pred_peaks_list)) + "]" # Plain join: tiny int lists, no NumPy formatter
+                           true_pks_s_list = sorted(p for p in true_peaks_row if p >= 0)
+                           true_peaks_str = "[" + ",".join(map(str, true_pks_s_list)) + "]"
                            num_true_peaks = len(true_pks_s_list)
-
-                           hits_s_topk_print = 0
-                           if sample_true_peaks_print.numel() > 0 and topk_indices_sorted_print.numel() > 0:
-                                dist_matrix_s_topk_print = torch.abs(sample_true_peaks_print.unsqueeze(1) - topk_indices_sorted_print.unsqueeze(0))
-                                min_dists_s_topk_print, _ = torch.min(dist_matrix_s_topk_print, dim=1)
-                                hits_s_topk_print = torch.sum(min_dists_s_topk_print <= args.accuracy_tolerance).item()
                            # --- MODIFIED: Updated print string ---
-                           tqdm.write(f"  [Train epoch {epoch+1}, B {batch_idx}, S {s}, Pt {current_pt_dbm_for_log:.1f}dBm] Hits(Top{k_top_print}):{hits_s_topk_print}/{num_true_peaks} | T: {true_peaks_str}, P(Top{k_top_print}): {pred_peaks_str}", file=sys.stdout)
+                           debug_lines.append(f"  [Train epoch {epoch+1}, B {batch_idx}, S {s}, Pt {current_pt_dbm_for_log:.1f}dBm] Hits(Top{k_top_print}):{hits_s_topk_print}/{num_true_peaks} | T: {true_peaks_str}, P(Top{k_top_print}): {pred_peaks_str}")
                            # ---
-                 sys.stdout.flush()
-                 tqdm.write("-" * 20, file=sys.stdout)
+                 debug_lines.append("-" * 20)
+                 tqdm.write("\n".join(debug_lines), file=sys.stdout)
 
 
         # --- End of Training Epoch ---
+        epoch_train_loss, epoch_train_topk_accuracy_sum = torch.stack((epoch_train_loss, epoch_train_topk_accuracy_sum)).tolist()
         avg_train_loss = epoch_train_loss / train_batch_count if train_batch_count > 0 else float('inf')
         avg_train_acc = epoch_train_topk_accuracy_sum / train_acc_batches if train_acc_batches > 0 else 0.0
-        train_losses.append(avg_train_loss)
-        train_acc_hist.append(avg_train_acc)
+        train_losses[epoch] = avg_train_loss
+        train_acc_hist[epoch] = avg_train_acc
+        epochs_run = epoch + 1
         if nan_skipped_count > 0: tqdm.write(f"Warning: Skipped {nan_skipped_count} NaN/Inf loss batches during epoch {epoch+1} training.", file=sys.stdout)
 
         # =================== Validation Phase (Multi-Point Fixed Power) ===================
         # Use the modified test_model function for validation across specified power levels
-        val_results_per_pt, _, _ = test_model( # Don't need viz data from validation
+        val_results_per_pt, _, _ = test_model( # Don't need viz data from validation (collect_viz defaults to False)
             model, val_loader, device, args, M_plus_1,
             args.val_pt_dbm_list, # Use the list of validation powers
             noise_std_dev_tensor
         )
 
         # Store history and determine loss for early stopping
-        current_critical_val_loss = float('inf')
-        valid_validation_run = False
         for pt, results in val_results_per_pt.items():
-            val_losses_hist[pt].append(results['loss'])
-            val_acc_hist[pt].append(results['accuracy'])
-            if results['count'] > 0: # Check if validation ran successfully for this pt
-                valid_validation_run = True # Mark validation as successful if at least one pt worked
-            if pt == critical_val_pt_dbm:
-                current_critical_val_loss = results['loss']
+            val_losses_hist[pt][epoch] = results['loss']
+            val_acc_hist[pt][epoch] = results['accuracy']
+        current_critical_val_loss = val_results_per_pt.get(critical_val_pt_dbm, {}).get('loss', float('inf'))
+        valid_validation_run = any(results['count'] > 0 for results in val_results_per_pt.values()) # Successful if at least one pt worked
 
 
         # --- Print Epoch Summary ---
-        tqdm.write(f"\nEpoch {epoch+1}/{epochs} Summary:", file=sys.stdout)
-        tqdm.write(f"  Train Loss ({args.loss_type.upper()}): {avg_train_loss:.4f} | Avg Train Top-{args.top_k} Hit Rate: {avg_train_acc:.3f}", file=sys.stdout)
-        tqdm.write(f"  --- Validation Results ---", file=sys.stdout)
-        val_loss_summary = []
+        summary_lines = [f"\nEpoch {epoch+1}/{epochs} Summary:",
+                         f"  Train Loss ({loss_name}): {avg_train_loss:.4f} | Avg Train Top-{args.top_k} Hit Rate: {avg_train_acc:.3f}",
+                         "  --- Validation Results ---"]
         val_acc_summary = []
         for pt in args.val_pt_dbm_list:
              loss = val_results_per_pt[pt]['loss']
              acc = val_results_per_pt[pt]['accuracy']
-             tqdm.write(f"    Pt={pt:.1f}dBm: Val Loss = {loss:.4f} | Avg Val Top-{args.top_k} Hit Rate = {acc:.3f}", file=sys.stdout)
+             summary_lines.append(f"    Pt={pt:.1f}dBm: Val Loss = {loss:.4f} | Avg Val Top-{args.top_k} Hit Rate = {acc:.3f}")
              if pt == critical_val_pt_dbm: # Highlight critical loss used for early stopping
-                 tqdm.write(f"      (Loss used for early stopping: {loss:.4f})", file=sys.stdout)
-             val_loss_summary.append(f"{loss:.3f}")
+                 summary_lines.append(f"      (Loss used for early stopping: {loss:.4f})")
              val_acc_summary.append(f"{acc:.3f}")
+        tqdm.write("\n".join(summary_lines), file=sys.stdout) # One write (one progress-bar redraw) for the whole summary
 
         # Update overall progress bar description
         critical_loss_str = f"{current_critical_val_loss:.3f}" if current_critical_val_loss != float('inf') else "inf"
@@ -1071,8 +1524,9 @@ def main():
             tqdm.write(f"  -> Validation loss at {critical_val_pt_dbm}dBm improved ({best_val_loss:.4f} -> {current_critical_val_loss:.4f}). Saving model...", file=sys.stdout)
             best_val_loss = current_critical_val_loss; early_stop_counter = 0
             model_save_path_tmp = os.path.join(folders['models'], f'best_model_{timestamp}.pt')
-            try: torch.save(model.state_dict(), model_save_path_tmp); model_save_path = model_save_path_tmp; tqdm.write(f"  Model saved to {model_save_path}", file=sys.stdout)
-            except Exception as e: tqdm.write(f"  Error saving model: {e}", file=sys.stdout)
+            # CPU snapshot (copy=True: on CPU .to() would alias the live parameters); the file is written on _ckpt_pool
+            state_cpu = {k: v.detach().to('cpu', copy=True) for k, v in model.state_dict().items()}
+            pending_checkpoint = _ckpt_pool.submit(_save_checkpoint, state_cpu, model_save_path_tmp); model_save_path = model_save_path_tmp
         else:
             if valid_validation_run: # Only increment counter if validation ran successfully
                 early_stop_counter += 1; tqdm.write(f"  Validation loss at {critical_val_pt_dbm}dBm did not improve. Counter: {early_stop_counter}/{args.patience}", file=sys.stdout)
@@ -1082,8 +1536,11 @@ def main():
                  tqdm.write(f"  Validation did not run properly (NaN/Inf loss?). Early stopping counter remains: {early_stop_counter}.", file=sys.stdout)
 
         # --- Epoch Cleanup ---
-        gc.collect();
-        if torch.cuda.is_available(): torch.cuda.empty_cache()
+        # Tensors are freed by reference counting; a full collection only matters for genuine cycles (opt-in, before empty_cache)
+        if args.gc_every_n_epochs > 0 and (epoch + 1) % args.gc_every_n_epochs == 0: gc.collect()
+        # Cached blocks are reused by the next epoch, so releasing them is opt-in (--empty_cache_every_n_epochs)
+        if device.type == 'cuda' and args.empty_cache_every_n_epochs > 0 and (epoch + 1) % args.empty_cache_every_n_epochs == 0:
+            torch.cuda.synchronize(); torch.cuda.empty_cache()
         tqdm.write("-" * 30, file=sys.stdout); sys.stdout.flush()
 
     # --- End of Training ---
@@ -1091,11 +1548,12 @@ def main():
 
     # --- Final Evaluation using Best/Last Model ---
     print("Loading best/final model for final evaluation...", flush=True)
+    if pending_checkpoint is not None: pending_checkpoint.result() # Wait for the last background save
     best_model_loaded = False
     final_model_path_used = "Final state (not saved or loaded)"
     if model_save_path and os.path.exists(model_save_path):
         try:
-            model.load_state_dict(torch.load(model_save_path, map_location=device))
+            model.load_state_dict(torch.load(model_save_path, map_location='cpu', weights_only=True)) # Copied into the existing (device) parameters; no second set of device tensors
             print(f"Successfully loaded best model: {model_save_path}", flush=True)
             best_model_loaded = True
             final_model_path_used = model_save_path
@@ -1105,7 +1563,7 @@ def main():
     elif load_path and os.path.exists(load_path) and (args.test_only or not best_model_loaded): # If test_only or training didn't save a better model
          try:
             # Reload the initially loaded model if it exists and no better one was found during training
-            model.load_state_dict(torch.load(load_path, map_location=device))
+            model.load_state_dict(torch.load(load_path, map_location='cpu', weights_only=True))
             print(f"Reloaded initial model for final test: {load_path}", flush=True)
             best_model_loaded = True
             final_model_path_used = load_path
@@ -1117,11 +1575,12 @@ def main():
 
 
     # --- Run Final Test (using multiple fixed test powers) ---
+    if device.type == 'cuda': gc.collect(); torch.cuda.synchronize(); torch.cuda.empty_cache() # Once: release training-only memory before testing
     # --- Call test_model with list ---
     final_test_results_per_pt, all_pred_probs_list_viz, all_targets_smooth_list_viz = test_model(
         model, test_loader, device, args, M_plus_1,
         args.val_pt_dbm_list, # Use the specified list of powers for final test
-        noise_std_dev_tensor
+        noise_std_dev_tensor, collect_viz=True
     )
     # ---
     print("\n===== Final Test Results (using loaded best/final model) =====")
@@ -1129,39 +1588,39 @@ def main():
     # Print final results for each tested power
     for pt, results in final_test_results_per_pt.items():
         print(f"--- Pt = {pt:.1f} dBm ---")
-        print(f"  Test loss ({args.loss_type.upper()}): {results['loss']:.6f}")
+        print(f"  Test loss ({loss_name}): {results['loss']:.6f}")
         print(f"  Test Top-{args.top_k} hit rate/recall: {results['accuracy']:.4f}")
 
     # --- Plotting and Saving Results ---
     print("\nGenerating plots and saving results...", flush=True)
-    epochs_run = len(train_losses)
     if epochs_run == 0: print("No epochs completed. Skipping plot generation.", flush=True)
     else:
         epoch_axis = range(1, epochs_run + 1)
+        # Per-Pt colors and legend labels for the loss and hit-rate subplots, built once
+        pt_colors = plt.cm.viridis(np.linspace(0, 1, len(args.val_pt_dbm_list)))
+        pt_labels = [f"{pt:.1f} dBm" for pt in args.val_pt_dbm_list]
+        val_loss_labels = [f'Val Loss ({label})' + (' [Early Stop]' if pt == critical_val_pt_dbm else '') for pt, label in zip(args.val_pt_dbm_list, pt_labels)]
+        val_acc_labels = [f'Val Top-{args.top_k} Hit Rate ({label}, Tol={args.accuracy_tolerance})' + (' [Early Stop Ref]' if pt == critical_val_pt_dbm else '') for pt, label in zip(args.val_pt_dbm_list, pt_labels)]
         fig, axs = plt.subplots(2, 1, figsize=(12, 10), sharex=True) # Increased height for more legends
 
         # Plot Loss
-        axs[0].plot(epoch_axis, train_losses, label=f'Training Loss ({args.loss_type.upper()})', marker='.', markersize=4, alpha=0.7, color='black')
+        axs[0].plot(epoch_axis, train_losses[:epochs_run], label=f'Training Loss ({loss_name})', marker='.', markersize=4, alpha=0.7, color='black')
         # Plot validation loss for each power level
-        colors = plt.cm.viridis(np.linspace(0, 1, len(args.val_pt_dbm_list)))
         for i, pt in enumerate(args.val_pt_dbm_list):
-            label = f'Val Loss ({pt:.1f} dBm)'
-            if pt == critical_val_pt_dbm:
-                label += ' [Early Stop]'
-            axs[0].plot(epoch_axis, val_losses_hist[pt], label=label, marker='.', markersize=4, alpha=0.7, color=colors[i])
+            axs[0].plot(epoch_axis, val_losses_hist[pt][:epochs_run], label=val_loss_labels[i], marker='.', markersize=4, alpha=0.7, color=pt_colors[i])
 
         axs[0].set_ylabel('Loss')
         axs[0].set_title(f'Training History ({timestamp}) - Samp:{args.power_sampling}, Kmax={args.max_targets}') # Added Kmax info
         axs[0].legend(fontsize='small'); axs[0].grid(True)
         # Adjust y-axis limit for loss
-        valid_losses = [l for l in train_losses if l is not None and not math.isinf(l) and not math.isnan(l)]
-        for pt in args.val_pt_dbm_list:
-            valid_losses.extend([l for l in val_losses_hist[pt] if l is not None and not math.isinf(l) and not math.isnan(l)])
-        if valid_losses:
-            min_loss_plot = max(0, min(valid_losses) - 0.1) if valid_losses else 0
-            # Avoid overly high initial losses dominating the plot
-            losses_after_epoch1 = [l for e, l in enumerate(valid_losses) if e > 0 or len(valid_losses) == 1] # Skip first epoch if multiple exist
-            percentile_loss = np.percentile(losses_after_epoch1, 98) if losses_after_epoch1 else (valid_losses[0] if valid_losses else 1.0)
+        # (1 + Npt, epochs_run): training row, then one row per validation power
+        loss_hist = np.stack([train_losses[:epochs_run]] + [val_losses_hist[pt][:epochs_run] for pt in args.val_pt_dbm_list])
+        loss_hist[~np.isfinite(loss_hist)] = np.nan
+        if not np.isnan(loss_hist).all():
+            min_loss_plot = max(0, np.nanmin(loss_hist) - 0.1)
+            # Avoid overly high initial losses dominating the plot: skip the first epoch of every curve if later ones exist
+            losses_after_epoch1 = loss_hist[:, 1:] if not np.isnan(loss_hist[:, 1:]).all() else loss_hist
+            percentile_loss = np.nanpercentile(losses_after_epoch1, 98)
             max_loss_plot = percentile_loss * 1.5
             if max_loss_plot > min_loss_plot + 1e-3: # Add small buffer to avoid same min/max
                  axs[0].set_ylim(min_loss_plot, max_loss_plot)
@@ -1170,13 +1629,10 @@ def main():
 
 
         # Plot Top-K Hit Rate
-        axs[1].plot(epoch_axis, [a * 100 for a in train_acc_hist], label=f'Training Top-{args.top_k} Hit Rate', marker='.', markersize=4, alpha=0.7, color='black')
+        axs[1].plot(epoch_axis, train_acc_hist[:epochs_run] * 100, label=f'Training Top-{args.top_k} Hit Rate', marker='.', markersize=4, alpha=0.7, color='black')
         # Plot validation accuracy for each power level
         for i, pt in enumerate(args.val_pt_dbm_list):
-            label = f'Val Top-{args.top_k} Hit Rate ({pt:.1f} dBm, Tol={args.accuracy_tolerance})'
-            if pt == critical_val_pt_dbm:
-                label += ' [Early Stop Ref]'
-            axs[1].plot(epoch_axis, [a * 100 for a in val_acc_hist[pt]], label=label, marker='.', markersize=4, alpha=0.7, color=colors[i])
+            axs[1].plot(epoch_axis, val_acc_hist[pt][:epochs_run] * 100, label=val_acc_labels[i], marker='.', markersize=4, alpha=0.7, color=pt_colors[i])
 
         axs[1].set_ylabel(f'Top-{args.top_k} Hit Rate / Recall (%)'); axs[1].set_xlabel('Epoch'); axs[1].legend(fontsize='small'); axs[1].grid(True); axs[1].set_ylim(-5, 105) # Start slightly below 0
 
@@ -1184,27 +1640,26 @@ def main():
         metrics_curve_path = os.path.join(folders['figures'], f'training_curves_{timestamp}.png')
         try: plt.savefig(metrics_curve_path); print(f"Training curves saved to {metrics_curve_path}", flush=True)
         except Exception as e: print(f"Error saving training curves plot: {e}", flush=True)
-        plt.close(fig)
+        fig.clf(); plt.close(fig)
 
     # Visualize final predictions (using data collected during the first power level test)
     visualize_predictions(all_pred_probs_list_viz, all_targets_smooth_list_viz, folders, timestamp + "_final_test", M_plus_1,
                           acc_threshold=args.accuracy_threshold,
                           acc_tolerance=args.accuracy_tolerance,
                           is_target_distribution=(args.loss_type=='kldiv'))
+    gc.collect() # Once, after the last figure: collect the Matplotlib reference cycles
 
     # --- Save Run Summary (Updated) ---
     summary_path = os.path.join(folders['outputs'], f'summary_{timestamp}.txt')
     print(f"Saving summary to {summary_path}", flush=True)
-    with open(summary_path, 'w', encoding='utf-8') as f:
+    with io.StringIO() as f: # Assembled in memory, written to summary_path in one call
         f.write(f"Experiment: CNN - Random Power Training ({args.power_sampling} sampling)\n") # Added sampling info
         f.write(f"Timestamp: {timestamp}\n"); f.write(f"Data root directory: {data_root}\n"); f.write(f"Output base directory: {folders['output_base']}\n"); f.write(f"Device: {device}\n")
         f.write("\n--- Parameters ---\n")
-        # --- Exclude num_targets if it somehow exists ---
-        args_dict = vars(args)
-        args_dict.pop('num_targets', None) # Remove if it exists
-        # Format list arg nicely
-        args_dict['val_pt_dbm_list'] = f"[{', '.join(map(str, args.val_pt_dbm_list))}]"
-        [f.write(f"  {k}: {v}\n") for k, v in sorted(args_dict.items())]
+        # Display-only formatting of the power list; args itself is never modified (num_targets skipped if it somehow exists)
+        pt_list_repr = "[" + ", ".join(f"{p:.1f}" for p in args.val_pt_dbm_list) + "]"
+        args_items = [(k, pt_list_repr if k == 'val_pt_dbm_list' else v) for k, v in sorted(vars(args).items()) if k != 'num_targets']
+        f.write("".join(f"  {k}: {v}\n" for k, v in args_items))
         # ---
         f.write("\n--- System Parameters ---\n")
         # --- Report K_data_param if available ---
@@ -1226,26 +1681,26 @@ def main():
         f.write(f"  Evaluation method: Top-K hit rate\n"); f.write(f"  K value (top_k): {args.top_k}\n"); f.write(f"  Tolerance: {args.accuracy_tolerance}\n"); f.write(f"  Visualization threshold (marking only): {args.accuracy_threshold}\n")
         f.write("\n--- Data Split ---\n"); f.write(f"  Target sizes: Train={train_size}, Val={val_size}, Test={test_size}\n"); f.write(f"  Reported lengths: Train={len(train_dataset)}, Val={len(val_dataset)}, Test={len(test_dataset)}\n")
         f.write("\n--- Model ---\n"); f.write(f"  Model parameter count: {count_parameters(model)}\n")
-        f.write("\n--- Loss Function ---\n"); f.write(f"  Loss type: {args.loss_type.upper()}\n"); f.write(f"  Target Sigma: {args.loss_sigma:.2f}\n");
+        f.write("\n--- Loss Function ---\n"); f.write(f"  Loss type: {loss_name}\n"); f.write(f"  Target Sigma: {args.loss_sigma:.2f}\n");
         f.write("\n--- Training Results ---\n");
         f.write(f"  Epochs run: {epochs_run}\n");
         f.write(f"  Early stopping based on lowest validation power: {critical_val_pt_dbm:.1f} dBm\n")
         f.write(f"  Best validation loss (at {critical_val_pt_dbm:.1f} dBm): {best_val_loss:.6f}\n")
         if epochs_run > 0:
-            final_train_loss = train_losses[-1] if train_losses else float('nan'); final_train_acc = train_acc_hist[-1] if train_acc_hist else float('nan')
+            final_train_loss = train_losses[epochs_run - 1]; final_train_acc = train_acc_hist[epochs_run - 1]
             f.write(f"  Final training loss: {final_train_loss:.4f}\n")
             f.write(f"  Final training Top-{args.top_k} hit rate/recall: {final_train_acc:.4f}\n")
             f.write(f"  Final validation results:\n")
             for pt in args.val_pt_dbm_list:
-                 final_val_loss = val_losses_hist[pt][-1] if val_losses_hist[pt] else float('nan')
-                 final_val_acc = val_acc_hist[pt][-1] if val_acc_hist[pt] else float('nan')
+                 final_val_loss = val_losses_hist[pt][epochs_run - 1]
+                 final_val_acc = val_acc_hist[pt][epochs_run - 1]
                  f.write(f"    Pt={pt:.1f}dBm: Loss={final_val_loss:.4f}, Top-{args.top_k} Hit={final_val_acc:.4f}\n")
         else: f.write("  No training epochs completed.\n")
         f.write("\n--- Final Test Results ---\n");
         f.write(f"  Using model: {final_model_path_used}\n")
         for pt, results in final_test_results_per_pt.items():
             f.write(f"  Pt = {pt:.1f} dBm:\n")
-            f.write(f"    Test loss ({args.loss_type.upper()}): {results['loss']:.6f}\n")
+            f.write(f"    Test loss ({loss_name}): {results['loss']:.6f}\n")
             f.write(f"    Test Top-{args.top_k} hit rate/recall: {results['accuracy']:.4f}\n")
         f.write("\n--- Saved Files ---\n"); f.write(f"  Output directory: {folders['output_base']}\n")
         f.write(f"  Model file/state used for final test: {final_model_path_used}\n")
@@ -1254,6 +1709,7 @@ def main():
         if os.path.exists(os.path.join(folders['figures'], plot_viz_filename)): f.write(f"  Final test prediction plot: {os.path.join(folders['figures'], plot_viz_filename)}\n")
         if saved_heatmap_count > 0: f.write(f"  Example input heatmaps: {os.path.join(folders['figures'], f'heatmap_input_sample_*_{timestamp}.png')}\n")
         f.write(f"  Summary file: {summary_path}\n")
+        with open(summary_path, 'w', encoding='utf-8') as summary_file: summary_file.write(f.getvalue())
 
     print(f"\nSummary saved to {summary_path}", flush=True)
     print("Script execution completed.", flush=True)